@@ -1,20 +1,318 @@
 from flask import Flask, request, jsonify, render_template
 import redis
+import atexit
 import json
+import math
+import queue
+import random
+import threading
+import time
+from collections import deque
 
 app = Flask(__name__)
 # Update the port to match the one on which the Redis server is currently running
 r = redis.Redis(host = 'localhost', port = 21081, decode_responses = True)
 
 GEO_KEY = "POIS"
+# Per amenity geo indexes kept next to GEO_KEY, written by convert.py and /add_location
+AMENITY_KEY = "POIS:amenity:{amenity}"
+MAX_AMENITIES = 10  # amenities one search can ask for
 CACHE_TTL = 60
 LOG_CHANNEL = "search_logs"
 LEADERBOARD_KEY = "search:leaderboard"
+# A search returns at most MAX_LIMIT POIs per page and can't page further than MAX_WINDOW POIs from the centre
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+MAX_WINDOW = 10000
+
+# "exact" caches every (lat, lon, radius, page) on its own. "grid" caches all POIs around the query's geohash
+# cell once per radius bucket and cuts that down to the exact circle in the app, so nearby queries share an entry
+CACHE_MODE = "grid"
+GRID_PRECISION = 6  # geohash characters, 6 is a cell of about 1.2 x 0.6 km
+RADIUS_BUCKETS = [250, 500, 1000, 2000, 5000, 10000]  # metres, larger radii always use the exact cache
+SUPERSET_MAX = 5000  # cells with more POIs around them than this aren't cached as one entry
+# Marks a cell found too dense for CACHE_TTL, so its searches skip straight to the exact cache
+DENSE_KEY = "cache:dense:{key}"
+# Same earth radius Redis uses for its distances
+EARTH_RADIUS = 6372797.560856
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# /nearest starts at NEAREST_START_RADIUS and grows it NEAREST_GROWTH times per try until it has k POIs,
+# POIs further than NEAREST_MAX_RADIUS are never returned
+DEFAULT_K = 10
+MAX_K = 100
+NEAREST_START_RADIUS = 500
+NEAREST_GROWTH = 4
+NEAREST_MAX_RADIUS = 50000
+
+# Search logs and leaderboard increments are sent by a background thread every REPORT_INTERVAL seconds in one
+# pipeline, so a cached search costs a single round trip. Only a sample of the per-search traffic is kept
+REPORT_INTERVAL = 1.0
+LOG_SAMPLE_RATE = 1.0  # fraction of CACHE_HIT / CACHE_MISS lines logged, errors and new POIs always are
+LEADERBOARD_SAMPLE_RATE = 1.0  # fraction of searches counted, each counts 1 / rate so the totals stay right
+LOG_QUEUE_SIZE = 10000  # sampled lines waiting for the next flush, more than that are dropped and counted
+
+cache_stats = {
+    "exact_hits": 0, "exact_misses": 0, "grid_hits": 0, "grid_misses": 0, "grid_bypassed": 0,
+    "nearest_hits": 0, "nearest_misses": 0, "nearest_bypassed": 0, "logs_dropped": 0
+}
+cache_stats_lock = threading.Lock()
 
 # ---------------------- UTILITIES ---------------------- #
-def log(message):
-    print("[LOG]", message)
-    r.publish(LOG_CHANNEL, message)
+log_queue = queue.Queue(maxsize = LOG_QUEUE_SIZE)
+# Errors and added POIs, never sampled and never dropped. There are few of them, so this isn't capped
+unsampled_logs = deque()
+leaderboard_pending = {}
+leaderboard_lock = threading.Lock()
+flush_lock = threading.Lock()
+
+def log(message, sampled = False):
+    if not sampled:
+        unsampled_logs.append(message)
+        return
+    if random.random() >= LOG_SAMPLE_RATE:
+        return
+    try:
+        log_queue.put_nowait(message)
+    except queue.Full:
+        with cache_stats_lock:
+            cache_stats["logs_dropped"] += 1
+
+def bump_leaderboard(key):
+    if random.random() >= LEADERBOARD_SAMPLE_RATE:
+        return
+    # Summed up here, the flush sends one ZINCRBY per distinct key
+    with leaderboard_lock:
+        leaderboard_pending[key] = leaderboard_pending.get(key, 0) + 1 / LEADERBOARD_SAMPLE_RATE
+
+def flush_reports():
+    global leaderboard_pending
+    with flush_lock:
+        messages = []
+        while unsampled_logs:
+            messages.append(unsampled_logs.popleft())
+        while True:
+            try:
+                messages.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+        with leaderboard_lock:
+            increments, leaderboard_pending = leaderboard_pending, {}
+        if not messages and not increments:
+            return
+
+        pipe = r.pipeline(transaction = False)
+        for message in messages:
+            print("[LOG]", message)
+            pipe.publish(LOG_CHANNEL, message)
+        for key, amount in increments.items():
+            pipe.zincrby(LEADERBOARD_KEY, amount, key)
+        pipe.execute()
+
+def report_loop():
+    while True:
+        time.sleep(REPORT_INTERVAL)
+        try:
+            flush_reports()
+        except Exception as e:
+            print("[LOG]", f"[ERROR] Could not flush search logs: {e}")
+
+threading.Thread(target = report_loop, name = "search-reporter", daemon = True).start()
+atexit.register(flush_reports)
+
+def int_arg(name, default, low, high):
+    value = int(request.args.get(name, default))
+    if not low <= value <= high:
+        raise ValueError(f"{name} must be between {low} and {high}")
+    return value
+
+def amenity_arg():
+    # ?amenity=cafe&amenity=bank or ?amenity=cafe,bank
+    amenities = sorted({
+        amenity.strip() for value in request.args.getlist("amenity") for amenity in value.split(",") if amenity.strip()
+    })
+    if len(amenities) > MAX_AMENITIES:
+        raise ValueError(f"at most {MAX_AMENITIES} amenities per search")
+    return amenities
+
+def geo_keys(amenities):
+    if not amenities:
+        return [GEO_KEY]
+    return [AMENITY_KEY.format(amenity = amenity) for amenity in amenities]
+
+def geosearch_keys(keys, longitude, latitude, radius, sort, count):
+    # One GEOSEARCH per index in a single round trip, merged back into one list ordered by distance.
+    # Each index stops at count, so the merged list holds the count nearest across all of them
+    pipe = r.pipeline(transaction = False)
+    for key in keys:
+        pipe.geosearch(
+            name = key,
+            longitude = longitude,
+            latitude = latitude,
+            radius = radius,
+            unit = 'm',
+            sort = sort,
+            count = count,
+            withdist = True,
+            withcoord = True
+        )
+    results = [item for result in pipe.execute() for item in result]
+    if len(keys) > 1:
+        results.sort(key = lambda item: item[1], reverse = sort == "DESC")
+    return results[:count]
+
+def with_metadata(results):
+    # All the hashes in one round trip instead of one HGETALL per POI
+    pipe = r.pipeline(transaction = False)
+    for item in results:
+        pipe.hgetall(f"poi:{item[0]}")
+
+    response = []
+    for item, meta in zip(results, pipe.execute()):
+        dist, coords = item[1], item[2]
+        meta["Latitude"] = coords[1]
+        meta["Longitude"] = coords[0]
+        meta["Distance"] = dist
+        response.append(meta)
+    return response
+
+def count_stat(stat):
+    with cache_stats_lock:
+        cache_stats[stat] += 1
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Distance in metres, the same formula GEOSEARCH uses
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+def geohash_cell(lat, lon, precision):
+    # Returns the geohash of the cell holding the point, the cell's centre and the furthest any point
+    # in the cell can be from that centre
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    cell = ""
+    bits = 0
+    even = True
+    while len(cell) < precision:
+        for _ in range(5):
+            value, bounds = (lon, lon_range) if even else (lat, lat_range)
+            mid = (bounds[0] + bounds[1]) / 2
+            bits <<= 1
+            if value >= mid:
+                bits |= 1
+                bounds[0] = mid
+            else:
+                bounds[1] = mid
+            even = not even
+        cell += GEOHASH_BASE32[bits]
+        bits = 0
+
+    center_lat = (lat_range[0] + lat_range[1]) / 2
+    center_lon = (lon_range[0] + lon_range[1]) / 2
+    half_diagonal = max(haversine(center_lat, center_lon, corner_lat, lon_range[1]) for corner_lat in lat_range)
+    return cell, center_lat, center_lon, half_diagonal
+
+def grid_search(lat, lon, radius, sort, amenities, exact_key):
+    # Every POI within radius of the query is within bucket + half_diagonal of its cell's centre, so that
+    # superset is cached once for the cell and filtered down here. Returns (matches, exact cache entry),
+    # matches is None when the area is too dense to cache and the exact cache has to answer instead
+    cell, center_lat, center_lon, half_diagonal = geohash_cell(lat, lon, GRID_PRECISION)
+    bucket = next(bucket for bucket in RADIUS_BUCKETS if bucket >= radius)
+    key = f"cache:grid:{cell}:{bucket}"
+    if amenities:
+        key += f":{','.join(amenities)}"
+
+    # The entry, the too-dense marker and the exact entry in one round trip, so a search in a dense cell
+    # that the exact cache can answer doesn't need a second one
+    cached, dense, exact_cached = r.mget(key, DENSE_KEY.format(key = key), exact_key)
+    if dense:
+        count_stat("grid_bypassed")
+        return None, exact_cached
+    if cached:
+        count_stat("grid_hits")
+        log(f"[INFO] CACHE_HIT for key: {key}", sampled = True)
+        candidates = json.loads(cached)
+    else:
+        results = geosearch_keys(
+            geo_keys(amenities), center_lon, center_lat, bucket + half_diagonal, 'ASC', SUPERSET_MAX + 1
+        )
+        if len(results) > SUPERSET_MAX:
+            count_stat("grid_bypassed")
+            r.set(DENSE_KEY.format(key = key), 1, ex = CACHE_TTL)
+            return None, exact_cached
+
+        count_stat("grid_misses")
+        log(f"[INFO] CACHE_MISS for key: {key}", sampled = True)
+        candidates = with_metadata(results)
+        r.set(key, json.dumps(candidates), ex=CACHE_TTL)
+    bump_leaderboard(key)
+
+    matches = []
+    for poi in candidates:
+        dist = haversine(lat, lon, poi["Latitude"], poi["Longitude"])
+        if dist <= radius:
+            poi["Distance"] = round(dist, 4)
+            matches.append(poi)
+    matches.sort(key = lambda poi: poi["Distance"], reverse = sort == "DESC")
+    return matches, exact_cached
+
+def expanding_search(keys, lon, lat, k):
+    # The k nearest within NEAREST_MAX_RADIUS, sparse areas just take a few more tries
+    radius = NEAREST_START_RADIUS
+    while True:
+        results = geosearch_keys(keys, lon, lat, radius, 'ASC', k)
+        if len(results) >= k or radius >= NEAREST_MAX_RADIUS:
+            return results
+        radius = min(radius * NEAREST_GROWTH, NEAREST_MAX_RADIUS)
+
+def nearest_search(lat, lon, k, amenities):
+    # Cached once per geohash cell and k. If the k nearest POIs to the cell's centre c are within d of it,
+    # the k nearest to any point q in the cell are within d + |qc| of q, so within d + 2 * half_diagonal of c.
+    # All POIs in that circle are cached and the exact k nearest to q are picked from them here
+    cell, center_lat, center_lon, half_diagonal = geohash_cell(lat, lon, GRID_PRECISION)
+    keys = geo_keys(amenities)
+    key = f"cache:nearest:{cell}:{k}"
+    if amenities:
+        key += f":{','.join(amenities)}"
+
+    cached, dense = r.mget(key, DENSE_KEY.format(key = key))
+    if dense:
+        count_stat("nearest_bypassed")
+        return with_metadata(expanding_search(keys, lon, lat, k))
+    if cached:
+        count_stat("nearest_hits")
+        log(f"[INFO] CACHE_HIT for key: {key}", sampled = True)
+        candidates = json.loads(cached)
+    else:
+        around_center = expanding_search(keys, center_lon, center_lat, k)
+        # 1m of slack for the rounding in Redis' distances
+        radius = NEAREST_MAX_RADIUS + half_diagonal + 1
+        if len(around_center) >= k:
+            radius = min(radius, around_center[-1][1] + 2 * half_diagonal + 1)
+
+        results = geosearch_keys(keys, center_lon, center_lat, radius, 'ASC', SUPERSET_MAX + 1)
+        if len(results) > SUPERSET_MAX:
+            count_stat("nearest_bypassed")
+            r.set(DENSE_KEY.format(key = key), 1, ex = CACHE_TTL)
+            return with_metadata(expanding_search(keys, lon, lat, k))
+
+        count_stat("nearest_misses")
+        log(f"[INFO] CACHE_MISS for key: {key}", sampled = True)
+        candidates = with_metadata(results)
+        r.set(key, json.dumps(candidates), ex=CACHE_TTL)
+    bump_leaderboard(key)
+
+    for poi in candidates:
+        poi["Distance"] = round(haversine(lat, lon, poi["Latitude"], poi["Longitude"]), 4)
+    candidates.sort(key = lambda poi: poi["Distance"])
+    return [poi for poi in candidates[:k] if poi["Distance"] <= NEAREST_MAX_RADIUS]
+
+def page_response(response, offset, limit):
+    # A full page means there may be more, the next one starts at X-Next-Offset
+    resp = jsonify(response)
+    if len(response) == limit and offset + limit < MAX_WINDOW:
+        resp.headers["X-Next-Offset"] = str(offset + limit)
+    return resp
 
 @app.route("/")
 def home():
@@ -27,43 +325,67 @@ def search():
         lat = float(request.args.get("lat"))
         lon = float(request.args.get("lon"))
         radius = float(request.args.get("radius"))
+        # Results come nearest first (or farthest first with sort=desc), one page at a time
+        sort = request.args.get("sort", "asc").upper()
+        if sort not in ("ASC", "DESC"):
+            raise ValueError("sort must be asc or desc")
+        limit = int_arg("limit", DEFAULT_LIMIT, 1, MAX_LIMIT)
+        offset = int_arg("offset", 0, 0, MAX_WINDOW - limit)
+        # Only these amenities, searched in their own indexes
+        amenities = amenity_arg()
 
-        key = f"cache:search:{lat}:{lon}:{radius}"
+        key = f"cache:search:{lat}:{lon}:{radius}:{sort}:{offset}:{limit}"
+        if amenities:
+            key += f":{','.join(amenities)}"
 
         # Checking the Redis cache to see if the POI has already been asked in the past 60 seconds
-        cached = r.get(key)
+        if CACHE_MODE == "grid" and radius <= RADIUS_BUCKETS[-1]:
+            response, cached = grid_search(lat, lon, radius, sort, amenities, key)
+            if response is not None:
+                return page_response(response[offset:offset + limit], offset, limit)
+        else:
+            cached = r.get(key)
         if cached:
-            log(f"[INFO] CACHE_HIT for key: {key}")
-            r.zincrby(LEADERBOARD_KEY, 1, key)
-            return jsonify(json.loads(cached))
-
-        # Performing geospatial search using the GEOSEARCH command in case of a Cache Miss
-        log(f"[INFO] CACHE_MISS for key: {key}")
-        results = r.geosearch(
-            name = GEO_KEY,
-            longitude = lon,
-            latitude = lat,
-            radius = radius,
-            unit = 'm',
-            withcoord = True
-        )
+            count_stat("exact_hits")
+            log(f"[INFO] CACHE_HIT for key: {key}", sampled = True)
+            bump_leaderboard(key)
+            return page_response(json.loads(cached), offset, limit)
+
+        # Performing geospatial search using the GEOSEARCH command in case of a Cache Miss,
+        # COUNT stops Redis at the end of the requested page instead of returning the whole radius
+        count_stat("exact_misses")
+        log(f"[INFO] CACHE_MISS for key: {key}", sampled = True)
+        results = geosearch_keys(geo_keys(amenities), lon, lat, radius, sort, offset + limit)
 
         # Constructing a response utilizing the hash metadata to return as the query's solution
-        response = []
-        for item in results:
-            node_id = item[0]
-            coords = item[1]
-            meta = r.hgetall(f"poi:{node_id}")
-            meta["Latitude"] = coords[1]
-            meta["Longitude"] = coords[0]
-            response.append(meta)
+        response = with_metadata(results[offset:])
 
         # Caching and returning the result
         r.set(key, json.dumps(response), ex=CACHE_TTL)
-        r.zincrby(LEADERBOARD_KEY, 1, key)
+        bump_leaderboard(key)
 
-        return jsonify(response)
+        return page_response(response, offset, limit)
 
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        log(f"[ERROR] {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# ---------------------- NEAREST POIS ---------------------- #
+@app.route("/nearest")
+def nearest():
+    try:
+        lat = float(request.args.get("lat"))
+        lon = float(request.args.get("lon"))
+        k = int_arg("k", DEFAULT_K, 1, MAX_K)
+        amenities = amenity_arg()
+
+        # Nearest first, each with its Distance in metres, however far the k-th one is
+        return jsonify(nearest_search(lat, lon, k, amenities))
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         log(f"[ERROR] {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -77,10 +399,16 @@ def add_location():
         lat = float(data["Latitude"])
         lon = float(data["Longitude"])
         name = data.get("Name", "")
-        amenity = data.get("Amenity", "")
+        amenity = (data.get("Amenity", "") or "").strip()
+        old_amenity = r.hget(f"poi:{node_id}", "Amenity")
 
-        # Add to geospatial index
-        r.geoadd(GEO_KEY, (lon, lat, node_id))
+        pipe = r.pipeline()
+        # Add to geospatial index, and to its amenity's. A POI whose amenity changed leaves the old one
+        pipe.geoadd(GEO_KEY, (lon, lat, node_id))
+        if amenity:
+            pipe.geoadd(AMENITY_KEY.format(amenity = amenity), (lon, lat, node_id))
+        if old_amenity and old_amenity != amenity:
+            pipe.zrem(AMENITY_KEY.format(amenity = old_amenity), node_id)
 
         # Store metadata as hash
         poi_metadata = {
@@ -89,7 +417,8 @@ def add_location():
             "Name": name
         }
 
-        r.hset(f"poi:{node_id}", mapping = poi_metadata)
+        pipe.hset(f"poi:{node_id}", mapping = poi_metadata)
+        pipe.execute()
 
         log(f"[INFO] Added new POI {node_id} at ({lat}, {lon})")
         return jsonify({"status": "success", "message": "Location added."})
@@ -106,6 +435,18 @@ def top_queries():
         {"query": key, "count": int(score)} for key, score in top
     ])
 
+# ---------------------- CACHE STATS ---------------------- #
+@app.route("/cache_stats")
+def search_cache_stats():
+    # Counted by this process since it started
+    with cache_stats_lock:
+        stats = dict(cache_stats)
+    hits = stats["exact_hits"] + stats["grid_hits"] + stats["nearest_hits"]
+    lookups = hits + stats["exact_misses"] + stats["grid_misses"] + stats["nearest_misses"]
+    stats["mode"] = CACHE_MODE
+    stats["hit_ratio_percent"] = hits / lookups * 100 if lookups else 0
+    return jsonify(stats)
+
 # ---------------------- START APP ---------------------- #
 if __name__ == "__main__":
     # Change the port to the port number on which you want to run the frontend
@@ -1,67 +1,369 @@
+import argparse
 import json
+import math
+import multiprocessing
+import os
+import time
 import redis
 
+GEO_KEY = "POIS"
+# Every POI with an amenity is also in its amenity's own index, so filtered searches only look at those
+AMENITY_KEY = "POIS:amenity:{amenity}"
+READ_SIZE = 1 << 20
+# An NDJSON line longer than this is rejected without reading all of it into memory
+MAX_LINE_SIZE = 16 << 20
+# Redis refuses coordinates outside of these (EPSG:900913 limits)
+MAX_LATITUDE = 85.05112878
+MAX_LONGITUDE = 180.0
+
+def parse_line(line):
+    # A line that isn't valid JSON comes back as its text, validate_poi then rejects it like any other bad POI
+    try:
+        return json.loads(line)
+    except ValueError:
+        return line.decode('utf-8', 'replace').strip() if isinstance(line, bytes) else line.strip()
+
+def sniff(f):
+    # Tells from the start of the file whether the input is NDJSON, i.e. its first line is a whole JSON object.
+    # A minified array is a single line, so it's decided from the first block and lines are never read before
+    # we know. Returns what was read so far, at most MAX_LINE_SIZE past the whitespace
+    buf = f.read(READ_SIZE)
+    while buf and not buf.strip():
+        buf = f.read(READ_SIZE)
+    first = buf.lstrip()
+    if not first or first.startswith("["):
+        return False, buf
+
+    eof = False
+    while "\n" not in first and len(first) <= MAX_LINE_SIZE:
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            eof = True
+            break
+        buf += chunk
+        first += chunk
+    end = first.find("\n")
+    if end < 0:
+        if not eof:
+            return False, buf
+        # The whole file is one line
+        end = len(first)
+    try:
+        return isinstance(json.loads(first[:end]), dict), buf
+    except ValueError:
+        return False, buf
+
+def iter_json_values(f):
+    # Yields the POIs one by one from NDJSON (one object per line) or a JSON array,
+    # only the current line, or the part of the array being parsed, is kept in memory
+    ndjson, buf = sniff(f)
+    if not ndjson:
+        # A JSON array, or not one POI per line either, e.g. a single pretty printed object
+        yield from iter_buffered(f, buf)
+        return
+
+    for line in iter_lines(f, buf):
+        if line.strip():
+            yield parse_line(line)
+
+def iter_lines(f, buf):
+    # The lines of the file, starting with what's left in buf. A line over MAX_LINE_SIZE comes back cut short,
+    # so validate_poi rejects it, and the rest of it is skipped without being kept
+    pos = 0
+    while True:
+        end = buf.find("\n", pos)
+        if end >= 0:
+            yield buf[pos:end]
+            pos = end + 1
+            continue
+
+        if len(buf) - pos > MAX_LINE_SIZE:
+            yield buf[pos:pos + 100] + "..."
+            buf, pos = "", 0
+            while True:
+                chunk = f.read(READ_SIZE)
+                if not chunk:
+                    return
+                end = chunk.find("\n")
+                if end >= 0:
+                    buf = chunk[end + 1:]
+                    break
+            continue
+
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            if pos < len(buf):
+                yield buf[pos:]
+            return
+        buf = buf[pos:] + chunk
+        pos = 0
+
+def iter_buffered(f, buf):
+    # JSON values parsed out of a buffer refilled READ_SIZE at a time, the items of a top-level array
+    # are yielded one by one
+    decoder = json.JSONDecoder()
+    pos = 0
+    eof = False
+    in_array = None
+
+    while True:
+        # Skip whitespace and, inside an array, the separators between its items
+        while pos < len(buf) and (buf[pos].isspace() or (in_array and buf[pos] == ",")):
+            pos += 1
+
+        if pos < len(buf):
+            if in_array is None:
+                in_array = buf[pos] == "["
+                if in_array:
+                    pos += 1
+                continue
+            if in_array and buf[pos] == "]":
+                return
+
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                # A value touching the end of the buffer may continue in the next read
+                if end < len(buf) or eof:
+                    yield value
+                    pos = end
+                    continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+
+        if eof:
+            if in_array:
+                raise ValueError("JSON array is missing its closing ]")
+            return
+
+        chunk = f.read(READ_SIZE)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
 def load_pois_from_json(filepath):
     with open(filepath, 'r', encoding = 'utf-8') as f:
-        data = json.load(f)
-        if isinstance(data, list):
-            return data
-        else:
-            return [data]
+        for value in iter_json_values(f):
+            if isinstance(value, list):
+                yield from value
+            else:
+                yield value
 
-def store_pois_in_redis(pois, redis_client):
+def validate_poi(poi):
+    # Returns (node_id, lon, lat, metadata), raises ValueError with the reason the POI can't be stored
+    if not isinstance(poi, dict):
+        raise ValueError("not a JSON object")
+
+    node_id = poi.get("ID")
+    if not node_id:
+        raise ValueError("missing ID")
+
+    try:
+        lat = float(poi.get("Latitude"))
+        lon = float(poi.get("Longitude"))
+    except (ValueError, TypeError):
+        raise ValueError("invalid coordinates")
+    if not (math.isfinite(lat) and math.isfinite(lon)) or abs(lat) > MAX_LATITUDE or abs(lon) > MAX_LONGITUDE:
+        raise ValueError("coordinates out of range")
+
+    poi_metadata = {
+        "ID": node_id,
+        "Amenity": (poi.get("Amenity", "") or "").strip(),
+        "Name": poi.get("Name:EN", "") or poi.get("Name", "") or ""
+    }
+    return str(node_id), lon, lat, poi_metadata
+
+def flush_chunk(chunk, redis_client):
+    # One GEOADD for the whole chunk plus an HSET per POI, sent in a single round trip.
+    # Not a transaction, every command is idempotent so a chunk that fails halfway can just be sent again
+    pipe = redis_client.pipeline(transaction = False)
+    members = []
+    by_amenity = {}
+    for node_id, lon, lat, poi_metadata in chunk:
+        members.extend((lon, lat, node_id))
+        if poi_metadata["Amenity"]:
+            by_amenity.setdefault(poi_metadata["Amenity"], []).extend((lon, lat, node_id))
+        pipe.hset(f'poi:{node_id}', mapping = poi_metadata)
+    pipe.geoadd(GEO_KEY, members)
+    for amenity, amenity_members in by_amenity.items():
+        pipe.geoadd(AMENITY_KEY.format(amenity = amenity), amenity_members)
+    pipe.execute()
+
+def store_pois_in_redis(pois, redis_client, chunk_size = 1000, rejects_file = None, progress_every = 100000, report = True):
     count = 0
+    rejected = {}
+    chunk = []
+    start = time.time()
 
     for poi in pois:
-        node_id = poi.get("ID")
-        if not node_id:
-            print(f"Skipping POI with missing ID: {poi}")
+        try:
+            chunk.append(validate_poi(poi))
+        except ValueError as e:
+            rejected[str(e)] = rejected.get(str(e), 0) + 1
+            if rejects_file:
+                rejects_file.write(json.dumps({"reason": str(e), "poi": poi}) + "\n")
             continue
 
+        if len(chunk) >= chunk_size:
+            flush_chunk(chunk, redis_client)
+            count += len(chunk)
+            chunk = []
+
+            if report and not count % progress_every:
+                elapsed = time.time() - start
+                print(f"Stored {count} POIs in Redis ({count / elapsed:.0f}/s, {sum(rejected.values())} rejected)...")
+
+    if chunk:
+        flush_chunk(chunk, redis_client)
+        count += len(chunk)
+
+    if report:
+        elapsed = time.time() - start
+        print(f"Finished storing {count} POIs in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f}/s).")
+        print_rejects(rejected)
+    return count, rejected
+
+def print_rejects(rejected):
+    for reason, reason_count in rejected.items():
+        print(f"Rejected {reason_count} POIs: {reason}")
+
+# ---------------------- PARALLEL LOAD ---------------------- #
+def shard_ranges(filepath, shards):
+    # Byte ranges of about the same size, a line belongs to the shard its first byte falls in
+    size = os.path.getsize(filepath)
+    step = max(1, -(-size // shards))
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+def iter_shard(filepath, start, end):
+    with open(filepath, 'rb') as f:
+        if start > 0:
+            # The line running over our start belongs to the previous shard, skip to the next one
+            f.seek(start - 1)
+            read_line(f)
+        while f.tell() < end:
+            line = read_line(f)
+            if not line:
+                break
+            if line.strip():
+                yield parse_line(line)
+
+def read_line(f):
+    # readline capped at MAX_LINE_SIZE, the rest of a longer line is skipped and what was read comes back
+    # cut short so validate_poi rejects it
+    line = f.readline(MAX_LINE_SIZE + 1)
+    if len(line) <= MAX_LINE_SIZE or line.endswith(b"\n"):
+        return line
+    rest = line
+    while rest and not rest.endswith(b"\n"):
+        rest = f.readline(READ_SIZE)
+    return line[:100] + b"..."
+
+def load_shard(job):
+    # Runs in a worker process, with its own Redis connection. Loading a shard twice writes the same
+    # GEOADD members and hash fields again, so a failed shard can simply be retried
+    index, filepath, start, end, settings = job
+    started = time.time()
+    try:
+        redis_client = redis.Redis(host = settings["host"], port = settings["port"], db = 0)
+        rejects_file = open(f"{settings['rejects']}.{index}", 'w', encoding = 'utf-8') if settings["rejects"] else None
         try:
-            lat = float(poi.get("Latitude"))
-            lon = float(poi.get("Longitude"))
-        except (ValueError, TypeError):
-            print(f"Skipping POI with invalid coordinates: {poi}")
-            continue
+            count, rejected = store_pois_in_redis(
+                iter_shard(filepath, start, end), redis_client, settings["chunk_size"], rejects_file, report = False
+            )
+        finally:
+            if rejects_file:
+                rejects_file.close()
+            redis_client.close()
+        return {"shard": index, "pid": os.getpid(), "count": count, "rejected": rejected,
+                "seconds": time.time() - started, "error": None}
+    except Exception as e:
+        return {"shard": index, "pid": os.getpid(), "count": 0, "rejected": {},
+                "seconds": time.time() - started, "error": str(e)}
 
-        amenity = poi.get("Amenity", "")
-        name = poi.get("Name", "")
-        name_en = poi.get("Name:EN", "")
+def is_ndjson(filepath):
+    # The first POI has to be a whole JSON object on its own line
+    with open(filepath, 'r', encoding = 'utf-8') as f:
+        ndjson, buf = sniff(f)
+        return ndjson or not buf.strip()
 
-        # Add to Redis GEO index
-        redis_client.geoadd('POIS', (lon, lat, str(node_id)))
+def parallel_load(filepath, workers, settings, shards_per_worker = 4, retries = 2):
+    # Byte range sharding only works when every POI is on its own line
+    if not is_ndjson(filepath):
+        raise ValueError(f"{filepath} isn't NDJSON, --workers needs one POI per line")
 
-        # Prepare Redis hash
-        poi_metadata = {
-            "ID": node_id,
-            "Amenity": amenity
-        }
+    ranges = shard_ranges(filepath, workers * shards_per_worker)
+    jobs = {index: (index, filepath, start, end, settings) for index, (start, end) in enumerate(ranges)}
+    results = []
+    start = time.time()
 
-        if name_en:
-            poi_metadata["Name"] = name_en
-        else:
-            poi_metadata["Name"] = name
+    with multiprocessing.Pool(workers) as pool:
+        for attempt in range(retries + 1):
+            failed = {}
+            for result in pool.imap_unordered(load_shard, jobs.values()):
+                if result["error"]:
+                    print(f"Shard {result['shard']} failed: {result['error']}")
+                    failed[result["shard"]] = jobs[result["shard"]]
+                else:
+                    results.append(result)
+                    print(f"Shard {result['shard']}: {result['count']} POIs in {result['seconds']:.1f}s "
+                          f"({result['count'] / result['seconds'] if result['seconds'] else 0:.0f}/s)")
+            jobs = failed
+            if not jobs:
+                break
+            if attempt < retries:
+                print(f"Retrying {len(jobs)} failed shards...")
 
-        redis_client.hset(f'poi:{node_id}', mapping=poi_metadata)
-        count += 1
+    elapsed = time.time() - start
+    count = sum(result["count"] for result in results)
+    rejected = {}
+    per_worker = {}
+    for result in results:
+        for reason, reason_count in result["rejected"].items():
+            rejected[reason] = rejected.get(reason, 0) + reason_count
+        worker = per_worker.setdefault(result["pid"], {"count": 0, "seconds": 0.0, "shards": 0})
+        worker["count"] += result["count"]
+        worker["seconds"] += result["seconds"]
+        worker["shards"] += 1
 
-        if not count%1000:
-            print(f"Stored {count} POIs in Redis...")
-    print(f"Finished storing {count} POIs.")
+    for pid, worker in per_worker.items():
+        rate = worker["count"] / worker["seconds"] if worker["seconds"] else 0
+        print(f"Worker {pid}: {worker['shards']} shards, {worker['count']} POIs, {rate:.0f}/s")
+    print(f"Finished storing {count} POIs in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f}/s) "
+          f"with {workers} workers.")
+    print_rejects(rejected)
+    if jobs:
+        print(f"{len(jobs)} shards still failed after {retries} retries: {sorted(jobs)}")
+    return count, rejected, sorted(jobs)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Load POIs from a JSON array or NDJSON file into Redis")
+    parser.add_argument("filepath", nargs = "?", default = "pois.json")
     # Update the port to match the one on which the Redis server is currently running
-    redis_client = redis.Redis(host='localhost', port=21081, db=0)
+    parser.add_argument("--host", default = "localhost")
+    parser.add_argument("--port", type = int, default = 21081)
+    parser.add_argument("--chunk-size", type = int, default = 1000, help = "POIs per pipeline round trip")
+    parser.add_argument("--rejects", help = "Write the POIs that fail validation to this NDJSON file "
+                                            "(one file per shard, with the shard number appended, with --workers)")
+    parser.add_argument("--workers", type = int, default = 1, help = "Processes loading an NDJSON file in parallel")
+    parser.add_argument("--retries", type = int, default = 2, help = "Times a failed shard is loaded again")
+    args = parser.parse_args()
 
-    json_file_path = "pois.json" 
-    print("Loading POIs from JSON...")
-    pois = load_pois_from_json(json_file_path)
+    redis_client = redis.Redis(host = args.host, port = args.port, db = 0)
 
-    print("Storing POIs in Redis...")
-    store_pois_in_redis(pois, redis_client)
+    if args.workers > 1:
+        print(f"Loading {args.filepath} into Redis with {args.workers} workers...")
+        settings = {"host": args.host, "port": args.port, "chunk_size": args.chunk_size, "rejects": args.rejects}
+        parallel_load(args.filepath, args.workers, settings, retries = args.retries)
+    else:
+        print(f"Streaming POIs from {args.filepath} into Redis...")
+        rejects_file = open(args.rejects, 'w', encoding = 'utf-8') if args.rejects else None
+        try:
+            store_pois_in_redis(load_pois_from_json(args.filepath), redis_client, args.chunk_size, rejects_file)
+        finally:
+            if rejects_file:
+                rejects_file.close()
 
     # Final count check
-    pois_count = redis_client.zcard('POIS')
+    pois_count = redis_client.zcard(GEO_KEY)
     print(f"Total POIs in Redis geospatial index: {pois_count}")
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import redis
+import redis.asyncio
+
+from cache_manager import (
+    open_sqlite, ReaderPool, initialize_schema, insert_row, insert_rows, index_suffixes, QUERY_GENERATION_KEY
+)
+from config import (
+    REDIS_CONFIG, REDIS_POOL_CONFIG, SQLITE_CONFIG, DEMO_CONFIG, L1_CONFIG, CODEC_CONFIG, NAMESPACE_CONFIG, ASYNC_CONFIG, STORAGE_CONFIG,
+    SCRIPT_CONFIG
+)
+from row_storage import column_converter, decode_cached, stage_row
+from serialization import get_serializer
+from write_scripts import WRITE_ROWS_SCRIPT, write_rows_args
+
+
+class AsyncWriteThroughCacheManager:
+    # same keys, values and stats as WriteThoughCacheManager, so both can serve the same cache side by side.
+    # redis calls are native asyncio; sqlite runs on a small pool of reader threads plus one writer thread
+    
+    def __init__(self):
+        self.redis_pool = None
+        self.redis_client = None
+        self.serializer = get_serializer(CODEC_CONFIG)
+        self.hash_tables = set(STORAGE_CONFIG['hash_tables'])
+        self._converters = {}
+        self._read_executor = None
+        # a single writer thread serializes writes the way write_lock does in the sync manager
+        self._write_executor = None
+        self._writer_conn = None
+        # one pooled connection per reader thread at most, the executor never runs more reads than that
+        self.readers = ReaderPool(ASYNC_CONFIG['sqlite_read_workers'], SQLITE_CONFIG['timeout'])
+        self._inflight = {}  # cache_key -> Task of the load currently running for it
+        self._generations = {}
+        self._instance_id = uuid.uuid4().hex
+        self.stats = {
+            'cache_hits': 0,
+            'cache_misses': 0,
+            'total_reads': 0,
+            'total_writes': 0,
+            'batch_writes': 0,
+            'coalesced_loads': 0
+        }
+    
+    async def connect(self):
+        try:
+            self.redis_pool = redis.asyncio.BlockingConnectionPool(
+                max_connections=REDIS_POOL_CONFIG['max_connections'] + REDIS_POOL_CONFIG['cache_max_connections'],
+                timeout=REDIS_POOL_CONFIG['pool_timeout'],
+                **{**REDIS_CONFIG, 'decode_responses': False}
+            )
+            self.redis_client = redis.asyncio.Redis(connection_pool=self.redis_pool)
+            await self.redis_client.ping()
+            self._write_rows_script = self.redis_client.register_script(WRITE_ROWS_SCRIPT)
+            print("Connected to Redis successfully (asyncio)")
+            
+            self._read_executor = ThreadPoolExecutor(
+                max_workers=ASYNC_CONFIG['sqlite_read_workers'], thread_name_prefix='sqlite-read'
+            )
+            self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-write')
+            self._writer_conn = await self._run_write(open_sqlite)
+            await self._run_write(self._writer_conn.execute, "PRAGMA journal_mode=WAL")
+            await self._run_write(initialize_schema, self._writer_conn)
+            print("Connected to SQLite successfully")
+        
+        except redis.ConnectionError as e:
+            raise ConnectionError(f"Failed to connect to Redis: {e}")
+        except sqlite3.Error as e:
+            raise ConnectionError(f"Failed to connect to SQLite: {e}")
+    
+    async def _run_read(self, func: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._read_executor, func, *args)
+    
+    async def _run_write(self, func: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._write_executor, func, *args)
+    
+    async def _generate_cache_key(self, table: str, key: Union[str, int]) -> str:
+        if NAMESPACE_CONFIG['mode'] == 'generation':
+            return f"{table}:v{await self._generation(table)}:{key}"
+        return f"{table}:{key}"
+    
+    async def _generation(self, table: str) -> int:
+        generation, fetched_at = self._generations.get(table, (0, 0))
+        if time.time() - fetched_at > NAMESPACE_CONFIG['generation_refresh_interval']:
+            generation = int(await self.redis_client.get(f"{NAMESPACE_CONFIG['generation_prefix']}{table}") or 0)
+            self._generations[table] = (generation, time.time())
+        return generation
+    
+    def _invalidate(self, pipe, cache_keys: List[str]):
+        # sync managers with an L1 in front of redis have to hear about our writes too
+        if L1_CONFIG['enabled']:
+            pipe.publish(L1_CONFIG['channel'], json.dumps({'origin': self._instance_id, 'keys': cache_keys}))
+    
+    async def _invalidate_indexes(self, pipe, table: str, rows: List[Dict]):
+        # same index and query keys get_by/query in the sync manager cache
+        index_keys = [await self._generate_cache_key(table, suffix) for suffix in index_suffixes(table, rows)]
+        if index_keys:
+            pipe.delete(*index_keys)
+        pipe.incr(QUERY_GENERATION_KEY.format(table=table))
+    
+    async def get(self, table: str, key: Union[str, int]) -> Optional[Dict]:
+        try:
+            cache_key = await self._generate_cache_key(table, key)
+            if table in self.hash_tables:
+                cached_data = await self.redis_client.hgetall(cache_key)
+            else:
+                cached_data = await self.redis_client.get(cache_key)
+            self.stats['total_reads'] += 1
+            if cached_data:
+                self.stats['cache_hits'] += 1
+                return (await self._decode(table, cached_data))[1]
+            
+            self.stats['cache_misses'] += 1
+            return await self._load_coalesced(table, key, cache_key)
+        
+        except Exception as e:
+            print(f"Error during get operation: {e}")
+            return None
+    
+    async def _load_coalesced(self, table: str, key: Union[str, int], cache_key: str) -> Optional[Dict]:
+        task = self._inflight.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(self._load_row(table, key, cache_key))
+            self._inflight[cache_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(cache_key, None))
+        else:
+            self.stats['coalesced_loads'] += 1
+        
+        # shield so one cancelled caller doesn't cancel the load everyone else is waiting on
+        data = await asyncio.shield(task)
+        return dict(data) if data is not None else None
+    
+    async def _load_row(self, table: str, key: Union[str, int], cache_key: str) -> Optional[Dict]:
+        data = await self._run_read(self._select_row, table, key)
+        
+        ttl = DEMO_CONFIG['cache_ttl'] if data is not None else DEMO_CONFIG['negative_cache_ttl']
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            stage_row(pipe, cache_key, data, ttl, self.serializer, table in self.hash_tables)
+            await pipe.execute()
+        return data
+    
+    async def _decode(self, table: str, raw: Any) -> Tuple[bool, Optional[Dict]]:
+        converters = None
+        if table in self.hash_tables:
+            if table not in self._converters:
+                columns = await self._run_read(self._table_info, table)
+                self._converters[table] = {column['name']: column_converter(column['type']) for column in columns}
+            converters = self._converters[table]
+        return decode_cached(raw, self.serializer, converters)
+    
+    def _table_info(self, table: str) -> List:
+        with self.readers.connection() as conn:
+            return conn.execute(f"PRAGMA table_info({table})").fetchall()
+    
+    def _select_row(self, table: str, key: Union[str, int]) -> Optional[Dict]:
+        with self.readers.connection() as conn:
+            row = conn.execute(f"SELECT * FROM {table} WHERE id = ?", (key,)).fetchone()
+        return dict(row) if row else None
+    
+    def _select_rows(self, table: str, keys: List[Union[str, int]]) -> List[Dict]:
+        rows = []
+        chunk_size = DEMO_CONFIG['sql_in_chunk_size']
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            with self.readers.connection() as conn:
+                cursor = conn.execute(
+                    f"SELECT * FROM {table} WHERE id IN ({', '.join('?' for _ in chunk)})", chunk
+                )
+                rows.extend(dict(row) for row in cursor.fetchall())
+        return rows
+    
+    async def get_many(self, table: str, keys: List[Union[str, int]]) -> List[Optional[Dict]]:
+        if not keys:
+            return []
+        
+        try:
+            cache_keys = [await self._generate_cache_key(table, key) for key in keys]
+            results = {}
+            missing = {}
+            if table in self.hash_tables:
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    for cache_key in cache_keys:
+                        pipe.hgetall(cache_key)
+                    cached_values = await pipe.execute()
+            else:
+                cached_values = await self.redis_client.mget(cache_keys)
+            for key, cache_key, cached_data in zip(keys, cache_keys, cached_values):
+                if cached_data:
+                    results[cache_key] = (await self._decode(table, cached_data))[1]
+                else:
+                    missing[cache_key] = key
+            
+            hits = sum(1 for cache_key in cache_keys if cache_key in results)
+            self.stats['cache_hits'] += hits
+            self.stats['cache_misses'] += len(keys) - hits
+            self.stats['total_reads'] += len(keys)
+            
+            if missing:
+                missing_by_id = {str(key): cache_key for cache_key, key in missing.items()}
+                for data in await self._run_read(self._select_rows, table, list(missing.values())):
+                    results[missing_by_id[str(data['id'])]] = data
+                await self._cache_many(table, [(cache_key, results.get(cache_key)) for cache_key in missing])
+            
+            return [results.get(cache_key) for cache_key in cache_keys]
+        
+        except Exception as e:
+            print(f"Error during get_many operation: {e}")
+            return [None] * len(keys)
+    
+    async def _cache_many(self, table: str, entries: List, invalidate: bool = False):
+        chunk_size = DEMO_CONFIG['pipeline_chunk_size']
+        for i in range(0, len(entries), chunk_size):
+            chunk = entries[i:i + chunk_size]
+            if invalidate and SCRIPT_CONFIG['enabled']:
+                await self._write_rows(table, chunk)
+                continue
+            
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for cache_key, cache_data in chunk:
+                    ttl = DEMO_CONFIG['cache_ttl'] if cache_data is not None else DEMO_CONFIG['negative_cache_ttl']
+                    stage_row(pipe, cache_key, cache_data, ttl, self.serializer, table in self.hash_tables)
+                if invalidate:
+                    self._invalidate(pipe, [cache_key for cache_key, _ in chunk])
+                    await self._invalidate_indexes(pipe, table, [cache_data for _, cache_data in chunk])
+                await pipe.execute()
+    
+    async def _write_rows(self, table: str, entries: List[Tuple[str, Dict]]):
+        # the same WRITE_ROWS_SCRIPT call as the sync manager, so writes from here also bump the shared write counts
+        cache_keys = [cache_key for cache_key, _ in entries]
+        message = {'origin': self._instance_id, 'keys': cache_keys} if L1_CONFIG['enabled'] else None
+        rows = [(cache_key, cache_data, DEMO_CONFIG['cache_ttl']) for cache_key, cache_data in entries]
+        index_keys = [
+            await self._generate_cache_key(table, suffix)
+            for suffix in index_suffixes(table, [cache_data for _, cache_data in entries])
+        ]
+        keys, args = write_rows_args(
+            table, rows, index_keys, QUERY_GENERATION_KEY.format(table=table), SCRIPT_CONFIG['stats_key'],
+            self.serializer, table in self.hash_tables, L1_CONFIG['channel'] if message else None, message
+        )
+        await self._write_rows_script(keys=keys, args=args)
+    
+    def _insert(self, table: str, data: Dict, key_field: str) -> Optional[int]:
+        # runs on the writer thread
+        db_data = data.copy()
+        if key_field in db_data and db_data[key_field] in (None, ''):
+            del db_data[key_field]
+        if 'id' in db_data and key_field != 'id':
+            del db_data['id']
+        
+        columns = tuple(db_data.keys())
+        record_id = insert_row(self._writer_conn.cursor(), table, columns, [db_data[col] for col in columns])
+        if record_id is None:
+            self._writer_conn.rollback()
+        else:
+            self._writer_conn.commit()
+        return record_id
+    
+    async def set(self, table: str, data: Dict, key_field: str = 'id') -> bool:
+        try:
+            record_id = await self._run_write(self._insert, table, data, key_field)
+            if record_id is None:
+                print(f"[ERROR] {table} row conflicts with an existing one (UNIQUE constraint), not written")
+                return False
+            
+            cache_data = data.copy()
+            cache_data[key_field] = record_id
+            cache_key = await self._generate_cache_key(table, record_id)
+            await self._cache_many(table, [(cache_key, cache_data)], invalidate=True)
+            
+            self.stats['total_writes'] += 1
+            return True
+        
+        except Exception as e:
+            print(f"Error during write operation: {e}")
+            return False
+    
+    async def batch_write(self, table: str, data_list: List[Dict]) -> int:
+        successful_writes = 0
+        
+        try:
+            written = await self._run_write(insert_rows, self._writer_conn, table, data_list)
+            successful_writes = len(written)
+            
+            await self._cache_many(
+                table,
+                [(await self._generate_cache_key(table, cache_data['id']), cache_data) for cache_data in written],
+                invalidate=True
+            )
+            
+            self.stats['total_writes'] += successful_writes
+            self.stats['batch_writes'] += 1
+            return successful_writes
+        
+        except Exception as e:
+            print(f"Error during batch write: {e}")
+            return successful_writes
+    
+    def get_cache_stats(self) -> Dict:
+        total_reads = self.stats['total_reads']
+        hit_ratio = (self.stats['cache_hits'] / total_reads * 100) if total_reads > 0 else 0
+        
+        return {
+            'cache_hits': self.stats['cache_hits'],
+            'cache_misses': self.stats['cache_misses'],
+            'total_reads': total_reads,
+            'total_writes': self.stats['total_writes'],
+            'batch_writes': self.stats['batch_writes'],
+            'hit_ratio_percent': hit_ratio,
+            'coalesced_loads': self.stats['coalesced_loads']
+        }
+    
+    async def close(self):
+        try:
+            if self.redis_client:
+                await self.redis_client.aclose()
+            if self.redis_pool:
+                await self.redis_pool.disconnect()
+            if self._read_executor:
+                self._read_executor.shutdown(wait=True)
+            if self._write_executor:
+                if self._writer_conn:
+                    await self._run_write(self._writer_conn.close)
+                self._write_executor.shutdown(wait=True)
+            self.readers.close()
+        except Exception as e:
+            print(f"Error closing connections: {e}")
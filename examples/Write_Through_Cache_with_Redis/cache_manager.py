@@ -2,62 +2,425 @@
 
 import sqlite3
 import redis
+import hashlib
 import json
+import logging
+import math
+import os
+import socket
 import time
+import random
 import threading
-from typing import Any, Dict, List, Optional, Union
-from concurrent.futures import ThreadPoolExecutor
-from config import REDIS_CONFIG, SQLITE_CONFIG, DEMO_CONFIG
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from config import (
+    REDIS_CONFIG, REDIS_POOL_CONFIG, SQLITE_CONFIG, DEMO_CONFIG, WRITE_BEHIND_CONFIG, PERF_LOG_CONFIG, L1_CONFIG,
+    STAMPEDE_CONFIG, CODEC_CONFIG, NAMESPACE_CONFIG, METRICS_CONFIG, INDEX_CONFIG, STORAGE_CONFIG, TTL_POLICY_CONFIG,
+    SCRIPT_CONFIG, LOG_LEVEL
+)
+from local_cache import LocalCache
+from metrics import Counters, LatencyTracker, render_prometheus, start_metrics_server
+from row_storage import (
+    HASH_UPDATE_SCRIPT, MISSING_FIELD, column_converter, decode_cached, decode_fields, raw_size, stage_read,
+    stage_row, update_args
+)
+from serialization import get_serializer
+from ttl_policy import get_ttl_policy
+from write_scripts import WRITE_ROWS_SCRIPT, write_rows_args
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+# RETURNING needs sqlite 3.35, older builds (some z/OS installs) fall back to catching IntegrityError
+SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+@lru_cache(maxsize=512)
+def insert_sql(table: str, columns: Tuple[str, ...], on_conflict: str = '') -> str:
+    # one string per (table, column set), which also lets sqlite3's statement cache reuse the prepared statement
+    return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}){on_conflict}"
+
+
+@lru_cache(maxsize=512)
+def upsert_sql(table: str, columns: Tuple[str, ...]) -> str:
+    updates = ', '.join(f"{col} = excluded.{col}" for col in columns if col != 'id')
+    return insert_sql(table, columns, f" ON CONFLICT(id) DO UPDATE SET {updates}")
+
+
+@lru_cache(maxsize=512)
+def update_sql(table: str, columns: Tuple[str, ...]) -> str:
+    # values go in column order, then the id
+    return f"UPDATE {table} SET {', '.join(f'{col} = ?' for col in columns)} WHERE id = ?"
+
+
+def open_sqlite(read_only: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        SQLITE_CONFIG['database_path'],
+        timeout=SQLITE_CONFIG['timeout'],
+        check_same_thread=False,
+        cached_statements=SQLITE_CONFIG['cached_statements']
+    )
+    conn.row_factory = sqlite3.Row
+    
+    # speed things up
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size={SQLITE_CONFIG['cache_size']}")
+    conn.execute("PRAGMA temp_store=memory")
+    if read_only:
+        conn.execute("PRAGMA query_only=ON")
+    return conn
+
+
+class ReaderPool:
+    # read-only connections shared by every thread, checked out around a read and handed back after it,
+    # so short lived threads don't each leave an open connection behind
+    def __init__(self, max_size: int, timeout: float):
+        self.timeout = timeout
+        self._idle = LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._all = []
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError("no sqlite reader free")
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                conn = open_sqlite(read_only=True)
+                with self._lock:
+                    self._all.append(conn)
+            try:
+                yield conn
+            finally:
+                # a read that failed halfway shouldn't leave its transaction open for the next borrower
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+    
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all = []
+
+
+def initialize_schema(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            profile_data TEXT
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            price REAL NOT NULL,
+            category TEXT,
+            description TEXT,
+            stock_quantity INTEGER DEFAULT 0
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS performance_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            operation_type TEXT NOT NULL,
+            execution_time REAL NOT NULL,
+            cache_used BOOLEAN DEFAULT FALSE,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            table_name TEXT,
+            record_key TEXT
+        )
+    ''')
+    
+    # databases created before the preloader don't have the row columns yet
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(performance_log)").fetchall()}
+    for column in ('table_name', 'record_key'):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE performance_log ADD COLUMN {column} TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_performance_log_timestamp ON performance_log(timestamp)")
+    
+    conn.commit()
+
+
+def insert_row(cursor, table: str, columns: Tuple[str, ...], values: List) -> Optional[int]:
+    # duplicates are caught by the UNIQUE constraints, not by a lookup before every insert; None means conflict
+    if SUPPORTS_RETURNING:
+        query = insert_sql(table, columns, " ON CONFLICT DO NOTHING RETURNING id")
+        logger.debug("SQL Query: %s Values: %s...", query, values[:2])
+        inserted = cursor.execute(query, values).fetchall()
+        return inserted[0][0] if inserted else None
+    
+    query = insert_sql(table, columns)
+    logger.debug("SQL Query: %s Values: %s...", query, values[:2])
+    try:
+        cursor.execute(query, values)
+        return cursor.lastrowid
+    except sqlite3.IntegrityError as e:
+        if 'UNIQUE' not in str(e):
+            raise
+        return None
+
+
+def insert_group(cursor, query: str, rows: List) -> List[Optional[int]]:
+    cursor.execute("SAVEPOINT batch_group")
+    try:
+        cursor.executemany(query, [values for _, _, values in rows])
+        # executemany doesn't set lastrowid, but ids in one statement from the only writer are contiguous
+        last_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+        cursor.execute("RELEASE SAVEPOINT batch_group")
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+    except sqlite3.Error:
+        cursor.execute("ROLLBACK TO SAVEPOINT batch_group")
+        cursor.execute("RELEASE SAVEPOINT batch_group")
+    
+    # something in this group is bad, redo it row by row so only the bad records fail
+    record_ids = []
+    for index, data, values in rows:
+        try:
+            cursor.execute(query, values)
+            record_ids.append(cursor.lastrowid)
+        except sqlite3.Error as e:
+            print(f"Error writing record {index}: {e}")
+            record_ids.append(None)
+    return record_ids
+
+
+def insert_rows(conn: sqlite3.Connection, table: str, data_list: List[Dict]) -> List[Dict]:
+    # returns a copy of every row that made it in, with its new id; call it from the connection's only writer
+    cursor = conn.cursor()
+    if not conn.in_transaction:
+        cursor.execute("BEGIN")
+    
+    # rows with the same columns share one INSERT, so each shape is a single executemany
+    groups = {}
+    for index, data in enumerate(data_list):
+        db_data = {col: value for col, value in data.items() if col != 'id'}
+        columns = tuple(db_data.keys())
+        groups.setdefault(columns, []).append((index, data, [db_data[col] for col in columns]))
+    
+    written = []
+    for columns, rows in groups.items():
+        for (index, data, _), record_id in zip(rows, insert_group(cursor, insert_sql(table, columns), rows)):
+            if record_id is not None:
+                written.append({**data, 'id': record_id})
+    
+    conn.commit()
+    return written
+
+
+# bumps the id counter up to the sqlite max without ever moving it backwards
+SEED_ID_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+def index_suffix(field: str, value: Any) -> str:
+    return f"idx:{field}:{value}"
+
+
+def index_suffixes(table: str, rows: Iterable[Dict]) -> Set[str]:
+    # index entries a write to these rows can change
+    fields = INDEX_CONFIG['fields'].get(table, ())
+    return {index_suffix(field, row[field]) for row in rows for field in fields if row.get(field) is not None}
+
+
+# bumped on every write to the table, query() results are cached under the current value
+QUERY_GENERATION_KEY = "{table}:qgen"
+
+# caches an id list only if no write bumped the table's generation since it was read
+FILL_IF_GENERATION_SCRIPT = """
+if (redis.call('GET', KEYS[1]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[3], 'EX', ARGV[2])
+return 1
+"""
+
+STAT_NAMES = (
+    'cache_hits', 'cache_misses', 'total_reads', 'total_writes', 'batch_writes',
+    'coalesced_loads', 'lease_waits', 'early_refreshes', 'index_hits', 'index_misses', 'query_hits', 'query_misses'
+)
+
+# only the worker holding the lease may drop it
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
 
 class WriteThoughCacheManager:
     
     def __init__(self):
+        self.redis_pool = None
         self.redis_client = None
+        # cached rows are bytes written by the serializer, so they go through their own binary client
+        self.cache_pool = None
+        self.cache_client = None
+        self.serializer = get_serializer(CODEC_CONFIG)
+        self.hash_tables = set(STORAGE_CONFIG['hash_tables'])
+        self._converters = {}  # table -> column -> how to turn a hash field back into a value
+        self.ttl_policy = get_ttl_policy(TTL_POLICY_CONFIG, DEMO_CONFIG['cache_ttl'])
+        self.use_scripts = SCRIPT_CONFIG['enabled']
+        # sqlite_conn is the single writer, reads borrow a connection from the reader pool
         self.sqlite_conn = None
-        self.write_queue = []
+        self.readers = ReaderPool(SQLITE_CONFIG['reader_pool_size'], SQLITE_CONFIG['timeout'])
         self.write_lock = threading.Lock()
-        self.stats = {
-            'cache_hits': 0,
-            'cache_misses': 0,
-            'total_reads': 0,
-            'total_writes': 0,
-            'batch_writes': 0
-        }
+        self.write_behind = WRITE_BEHIND_CONFIG['enabled']
+        self._seeded_tables = set()
+        self._flusher = None
+        self._flusher_stop = threading.Event()
+        # every process reads the stream under its own name, a shared one would mix up their pending entries
+        self._consumer = WRITE_BEHIND_CONFIG['consumer'] or f"flusher-{socket.gethostname()}-{os.getpid()}"
+        self._queue_cond = threading.Condition()
+        self._queue_depth = 0
+        self._perf_buffer = deque()
+        self._perf_dropped = 0
+        self._perf_flusher = None
+        self._perf_stop = threading.Event()
+        self.l1 = None
+        self._pubsub = None
+        self._pubsub_thread = None
+        self._instance_id = uuid.uuid4().hex
+        self._inflight = {}  # cache_key -> Future of the load currently running for it
+        self._inflight_lock = threading.Lock()
+        self._load_times = {}  # table -> moving average of the sqlite load time, used by xfetch
+        self._generations = {}  # table -> (generation, when we last read it), only used in generation mode
+        self.stats = Counters(STAT_NAMES)
+        self.latency = LatencyTracker()
+        self._metrics_server = None
         
     def connect(self):
         try:
-            # redis first
-            self.redis_client = redis.Redis(**REDIS_CONFIG)
+            # redis first, all threads share two bounded pools, their sizes add up to the connection budget
+            self.redis_pool = redis.BlockingConnectionPool(
+                max_connections=REDIS_POOL_CONFIG['max_connections'],
+                timeout=REDIS_POOL_CONFIG['pool_timeout'],
+                **REDIS_CONFIG
+            )
+            self.redis_client = redis.Redis(connection_pool=self.redis_pool)
+            self.cache_pool = redis.BlockingConnectionPool(
+                max_connections=REDIS_POOL_CONFIG['cache_max_connections'],
+                timeout=REDIS_POOL_CONFIG['pool_timeout'],
+                **{**REDIS_CONFIG, 'decode_responses': False}
+            )
+            self.cache_client = redis.Redis(connection_pool=self.cache_pool)
             self.redis_client.ping()
+            self._release_lease_script = self.redis_client.register_script(RELEASE_LEASE_SCRIPT)
+            self._fill_if_generation_script = self.cache_client.register_script(FILL_IF_GENERATION_SCRIPT)
+            self._hash_update_script = self.cache_client.register_script(HASH_UPDATE_SCRIPT)
+            # redis-py keeps the sha, runs EVALSHA and loads the script again if the server answers NOSCRIPT
+            self._write_rows_script = self.cache_client.register_script(WRITE_ROWS_SCRIPT)
             print("Connected to Redis successfully")
             self._log_redis_connection()
             
+            if L1_CONFIG['enabled']:
+                self._start_l1()
+            
             # then sqlite
             db_path = SQLITE_CONFIG['database_path']
-            print(f"[DEBUG] Connecting to SQLite database: {db_path}")
-            
-            self.sqlite_conn = sqlite3.connect(
-                db_path,
-                timeout=SQLITE_CONFIG['timeout'],
-                check_same_thread=False
-            )
-            self.sqlite_conn.row_factory = sqlite3.Row
+            logger.debug("Connecting to SQLite database: %s", db_path)
             
-            # speed things up
+            self.sqlite_conn = open_sqlite()
+            # WAL is what lets the reader connections run while the writer holds a transaction
             self.sqlite_conn.execute("PRAGMA journal_mode=WAL")
-            self.sqlite_conn.execute("PRAGMA synchronous=NORMAL")
-            self.sqlite_conn.execute("PRAGMA cache_size=10000")
-            self.sqlite_conn.execute("PRAGMA temp_store=memory")
             
             print("Connected to SQLite successfully")
             self._initialize_database()
             
+            self._perf_stop.clear()
+            self._perf_flusher = threading.Thread(target=self._perf_log_loop, name='perf-log-flusher', daemon=True)
+            self._perf_flusher.start()
+            
+            if self.write_behind:
+                self._start_write_behind()
+            
+            if METRICS_CONFIG['http_port']:
+                self._metrics_server = start_metrics_server(
+                    self.export_prometheus, METRICS_CONFIG['http_host'], METRICS_CONFIG['http_port']
+                )
+                print(f"Metrics at http://{METRICS_CONFIG['http_host']}:{METRICS_CONFIG['http_port']}/metrics")
+            
         except redis.ConnectionError as e:
             raise ConnectionError(f"Failed to connect to Redis: {e}")
         except sqlite3.Error as e:
             raise ConnectionError(f"Failed to connect to SQLite: {e}")
     
+    def _start_l1(self):
+        self.l1 = LocalCache(L1_CONFIG['max_entries'], L1_CONFIG['max_bytes'], L1_CONFIG['ttl'])
+        
+        # other processes tell us which keys they wrote, our own messages are skipped by origin
+        self._pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{L1_CONFIG['channel']: self._on_invalidate})
+        self._pubsub_thread = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+        print(f"L1 cache on, listening for invalidations on {L1_CONFIG['channel']}")
+    
+    def _on_invalidate(self, message: Dict):
+        try:
+            payload = json.loads(message['data'])
+            if payload['origin'] == self._instance_id:
+                return
+            
+            if payload['keys'] == '*':
+                self.l1.clear()
+            else:
+                for cache_key in payload['keys']:
+                    self.l1.invalidate(cache_key)
+        except Exception as e:
+            print(f"Warning: bad invalidation message: {e}")
+    
+    def _l1_get(self, cache_key: str) -> Tuple[bool, Optional[Dict]]:
+        if not self.l1:
+            return False, None
+        
+        found, value = self.l1.get(cache_key)
+        # callers get their own copy so they can't change what the next reader sees
+        return found, dict(value) if value is not None else None
+    
+    def _l1_set(self, cache_key: str, value: Optional[Dict], size: int, ttl: Optional[float] = None):
+        # ttl is what the entry has left in redis when we know it, otherwise the ttl the policy would give it now
+        if not self.l1:
+            return
+        
+        if ttl is None:
+            ttl = self.ttl_policy.peek_ttl(cache_key) if value is not None else DEMO_CONFIG['negative_cache_ttl']
+        self.l1.set(cache_key, dict(value) if value is not None else None, size, ttl)
+    
+    def _invalidate(self, pipe, cache_keys: Union[List[str], str]):
+        # rides on the pipeline that writes the new values, so the broadcast is free
+        if not self.l1:
+            return
+        
+        if cache_keys == '*':
+            self.l1.clear()
+        else:
+            for cache_key in cache_keys:
+                self.l1.invalidate(cache_key)
+        pipe.publish(L1_CONFIG['channel'], json.dumps({'origin': self._instance_id, 'keys': cache_keys}))
+    
     def _log_redis_connection(self):
         try:
             connection_id = f"zos_demo_connection_{int(time.time())}"
@@ -80,85 +443,476 @@ class WriteThoughCacheManager:
             print(f"Warning: Could not set Redis activity markers: {e}")
     
     def _initialize_database(self):
-        cursor = self.sqlite_conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                profile_data TEXT
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                price REAL NOT NULL,
-                category TEXT,
-                description TEXT,
-                stock_quantity INTEGER DEFAULT 0
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS performance_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                operation_type TEXT NOT NULL,
-                execution_time REAL NOT NULL,
-                cache_used BOOLEAN DEFAULT FALSE,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        self.sqlite_conn.commit()
+        initialize_schema(self.sqlite_conn)
         print("Database schema initialized")
     
     def _generate_cache_key(self, table: str, key: Union[str, int]) -> str:
+        if NAMESPACE_CONFIG['mode'] == 'generation':
+            return f"{table}:v{self._generation(table)}:{key}"
         return f"{table}:{key}"
     
+    def _generation(self, table: str) -> int:
+        # re-read now and then so a flush from another process is picked up without a GET per operation
+        generation, fetched_at = self._generations.get(table, (0, 0))
+        if time.time() - fetched_at > NAMESPACE_CONFIG['generation_refresh_interval']:
+            generation = int(self.redis_client.get(f"{NAMESPACE_CONFIG['generation_prefix']}{table}") or 0)
+            self._generations[table] = (generation, time.time())
+        return generation
+    
     def get(self, table: str, key: Union[str, int]) -> Optional[Dict]:
         start_time = time.time()
+        self.latency.start()
         cache_key = self._generate_cache_key(table, key)
         
         try:
-            cached_data = self.redis_client.get(cache_key)
-            if cached_data:
-                self.stats['cache_hits'] += 1
-                self.stats['total_reads'] += 1
-                self._log_performance('read', time.time() - start_time, True)
-                return json.loads(cached_data)
+            self.ttl_policy.record_access(cache_key)
+            found, data = self._l1_get(cache_key)
+            if found:
+                self.stats.incr('cache_hits')
+                self.stats.incr('total_reads')
+                self._log_performance('read', time.time() - start_time, True, table, key)
+                return data
             
-            self.stats['cache_misses'] += 1
-            self.stats['total_reads'] += 1
+            with self.latency.timed('redis'):
+                extend_ttl = None if STAMPEDE_CONFIG['xfetch'] else self.ttl_policy.sliding_ttl(cache_key)
+                if STAMPEDE_CONFIG['xfetch'] or self.l1:
+                    # ttl comes back in the same round trip as the value, xfetch needs it and the l1 copy
+                    # mustn't outlive what's left of it in redis
+                    pipe = self.cache_client.pipeline(transaction=False)
+                    stage_read(pipe, cache_key, table in self.hash_tables)
+                    if extend_ttl:
+                        pipe.expire(cache_key, extend_ttl)
+                    pipe.pttl(cache_key)
+                    replies = pipe.execute()
+                    cached_data, ttl_ms = replies[0], replies[-1]
+                else:
+                    cached_data, ttl_ms = self._read_cached(table, cache_key, extend_ttl), None
             
-            cursor = self.sqlite_conn.cursor()
-            cursor.execute(f"SELECT * FROM {table} WHERE id = ?", (key,))
-            row = cursor.fetchone()
-            
-            if row:
-                data = dict(row)
-                
-                self.redis_client.setex(
-                    cache_key, 
-                    DEMO_CONFIG['cache_ttl'], 
-                    json.dumps(data, default=str)
-                )
-                
-                self._log_performance('read', time.time() - start_time, False)
+            if cached_data and not (STAMPEDE_CONFIG['xfetch'] and self._should_refresh_early(table, ttl_ms)):
+                self.stats.incr('cache_hits')
+                self.stats.incr('total_reads')
+                _, data = self._decode(table, cached_data)
+                self._l1_set(cache_key, data, raw_size(cached_data), ttl_ms / 1000 if ttl_ms and ttl_ms > 0 else None)
+                self._log_performance('read', time.time() - start_time, True, table, key)
                 return data
             
-            self._log_performance('read', time.time() - start_time, False)
-            return None
+            if cached_data:
+                self.stats.incr('cache_hits')
+                self.stats.incr('early_refreshes')
+            else:
+                self.stats.incr('cache_misses')
+            self.stats.incr('total_reads')
+            
+            data = self._load_coalesced(table, key, cache_key)
+            self._log_performance('read', time.time() - start_time, False, table, key)
+            return data
             
         except Exception as e:
             print(f"Error during get operation: {e}")
             return None
     
+    def _should_refresh_early(self, table: str, ttl_ms: Optional[int]) -> bool:
+        # xfetch: the closer to expiry and the slower the rebuild, the more likely one reader refreshes now
+        if ttl_ms is None or ttl_ms < 0 or table not in self._load_times:
+            return False
+        
+        delta = self._load_times[table]
+        return delta * STAMPEDE_CONFIG['xfetch_beta'] * -math.log(1.0 - random.random()) >= ttl_ms / 1000
+    
+    def _load_coalesced(self, table: str, key: Union[str, int], cache_key: str) -> Optional[Dict]:
+        if not STAMPEDE_CONFIG['coalesce']:
+            return self._load_with_lease(table, key, cache_key)
+        
+        with self._inflight_lock:
+            future = self._inflight.get(cache_key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[cache_key] = future
+        
+        if not leader:
+            # someone in this process is already loading the key, wait for their result
+            self.stats.incr('coalesced_loads')
+            data = future.result(timeout=STAMPEDE_CONFIG['wait_timeout'])
+            return dict(data) if data is not None else None
+        
+        try:
+            data = self._load_with_lease(table, key, cache_key)
+            future.set_result(dict(data) if data is not None else None)
+            return data
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(cache_key, None)
+    
+    def _load_with_lease(self, table: str, key: Union[str, int], cache_key: str) -> Optional[Dict]:
+        if not STAMPEDE_CONFIG['lease']:
+            return self._load_row(table, key, cache_key)
+        
+        lease_key = f"lease:{cache_key}"
+        token = uuid.uuid4().hex
+        with self.latency.timed('redis'):
+            acquired = self.redis_client.set(lease_key, token, nx=True, px=STAMPEDE_CONFIG['lease_ms'])
+        if not acquired:
+            # another worker is rebuilding this key, give it a moment to fill the cache
+            self.stats.incr('lease_waits')
+            deadline = time.time() + STAMPEDE_CONFIG['lease_wait']
+            while time.time() < deadline:
+                time.sleep(STAMPEDE_CONFIG['lease_poll_interval'])
+                with self.latency.timed('redis'):
+                    cached_data = self._read_cached(table, cache_key)
+                if cached_data:
+                    _, data = self._decode(table, cached_data)
+                    self._l1_set(cache_key, data, raw_size(cached_data))
+                    return data
+            # holder is slow or died, load it ourselves rather than fail the read
+            return self._load_row(table, key, cache_key)
+        
+        try:
+            return self._load_row(table, key, cache_key)
+        finally:
+            with self.latency.timed('redis'):
+                self._release_lease_script(keys=[lease_key], args=[token])
+    
+    def _load_row(self, table: str, key: Union[str, int], cache_key: str) -> Optional[Dict]:
+        load_start = time.time()
+        with self.latency.timed('sqlite'), self.readers.connection() as conn:
+            row = conn.execute(f"SELECT * FROM {table} WHERE id = ?", (key,)).fetchone()
+        
+        # moving average of how long a rebuild takes, xfetch scales early refreshes by it
+        load_time = time.time() - load_start
+        self._load_times[table] = 0.8 * self._load_times.get(table, load_time) + 0.2 * load_time
+        
+        # a row that doesn't exist is cached too, for a short while, so unknown ids don't hit sqlite every time
+        data = dict(row) if row else None
+        if data is not None and not self.ttl_policy.admit(cache_key):
+            return data
+        
+        ttl = self.ttl_policy.ttl_for(cache_key) if data is not None else DEMO_CONFIG['negative_cache_ttl']
+        pipe = self.cache_client.pipeline(transaction=False)
+        size = self._stage_row(pipe, table, cache_key, data, ttl)
+        with self.latency.timed('redis'):
+            pipe.execute()
+        self._l1_set(cache_key, data, size, ttl)
+        return data
+    
+    def _read_cached(self, table: str, cache_key: str, extend_ttl: Optional[int] = None) -> Any:
+        # extend_ttl also pushes the expiry out (sliding expiration) in the same round trip
+        if table in self.hash_tables:
+            if extend_ttl:
+                pipe = self.cache_client.pipeline(transaction=False)
+                pipe.hgetall(cache_key)
+                pipe.expire(cache_key, extend_ttl)
+                return pipe.execute()[0]
+            return self.cache_client.hgetall(cache_key)
+        if extend_ttl:
+            return self.cache_client.getex(cache_key, ex=extend_ttl)
+        return self.cache_client.get(cache_key)
+    
+    def _decode(self, table: str, raw: Any) -> Tuple[bool, Optional[Dict]]:
+        return decode_cached(raw, self.serializer, self._column_converters(table))
+    
+    def _stage_row(self, pipe, table: str, cache_key: str, data: Optional[Dict], ttl: int) -> int:
+        return stage_row(pipe, cache_key, data, ttl, self.serializer, table in self.hash_tables)
+    
+    def _column_converters(self, table: str) -> Optional[Dict[str, Callable]]:
+        # None for tables cached as serialized strings
+        if table not in self.hash_tables:
+            return None
+        if table not in self._converters:
+            with self.readers.connection() as conn:
+                columns = conn.execute(f"PRAGMA table_info({table})").fetchall()
+            self._converters[table] = {column['name']: column_converter(column['type']) for column in columns}
+        return self._converters[table]
+    
+    def get_many(self, table: str, keys: List[Union[str, int]]) -> List[Optional[Dict]]:
+        start_time = time.time()
+        if not keys:
+            return []
+        self.latency.start()
+        
+        try:
+            rows, all_cached = self._fetch_many(table, keys)
+            self._log_performance('read_many', time.time() - start_time, all_cached)
+            return rows
+            
+        except Exception as e:
+            print(f"Error during get_many operation: {e}")
+            return [None] * len(keys)
+    
+    def _fetch_many(self, table: str, keys: List[Union[str, int]]) -> Tuple[List[Optional[Dict]], bool]:
+        # get_many without the timing and error handling, so get_by/query can build on it
+        if not keys:
+            return [], True
+        
+        cache_keys = [self._generate_cache_key(table, key) for key in keys]
+        for cache_key in cache_keys:
+            self.ttl_policy.record_access(cache_key)
+        results = {}
+        missing = {}
+        remote = {}
+        for key, cache_key in zip(keys, cache_keys):
+            found, data = self._l1_get(cache_key)
+            if found:
+                results[cache_key] = data
+            else:
+                remote[cache_key] = key
+        
+        if remote:
+            with self.latency.timed('redis'):
+                pipe = self.cache_client.pipeline(transaction=False)
+                if table in self.hash_tables:
+                    for cache_key in remote:
+                        pipe.hgetall(cache_key)
+                else:
+                    pipe.mget(list(remote))
+                if self.l1:
+                    # what each row has left in redis, its l1 copy mustn't live longer
+                    for cache_key in remote:
+                        pipe.pttl(cache_key)
+                replies = pipe.execute()
+            remote_values = replies[:len(remote)] if table in self.hash_tables else replies[0]
+            ttls_ms = replies[-len(remote):] if self.l1 else [None] * len(remote)
+            for (cache_key, key), cached_data, ttl_ms in zip(remote.items(), remote_values, ttls_ms):
+                if cached_data:
+                    _, results[cache_key] = self._decode(table, cached_data)
+                    self._l1_set(cache_key, results[cache_key], raw_size(cached_data),
+                                 ttl_ms / 1000 if ttl_ms and ttl_ms > 0 else None)
+                else:
+                    missing[cache_key] = key
+        
+        hits = sum(1 for cache_key in cache_keys if cache_key in results)
+        self.stats.incr('cache_hits', hits)
+        self.stats.incr('cache_misses', len(keys) - hits)
+        self.stats.incr('total_reads', len(keys))
+        
+        if missing:
+            missing_keys = list(missing.values())
+            missing_by_id = {str(key): cache_key for cache_key, key in missing.items()}
+            chunk_size = DEMO_CONFIG['sql_in_chunk_size']
+            
+            for i in range(0, len(missing_keys), chunk_size):
+                chunk = missing_keys[i:i + chunk_size]
+                with self.latency.timed('sqlite'), self.readers.connection() as conn:
+                    rows = conn.execute(
+                        f"SELECT * FROM {table} WHERE id IN ({', '.join('?' for _ in chunk)})",
+                        chunk
+                    ).fetchall()
+                for row in rows:
+                    data = dict(row)
+                    results[missing_by_id[str(data['id'])]] = data
+            
+            # ids that aren't in sqlite either get cached as null
+            self._cache_many(table, [(cache_key, results.get(cache_key)) for cache_key in missing])
+        
+        return [results.get(cache_key) for cache_key in cache_keys], not missing
+    
+    def get_by(self, table: str, field: str, value: Any) -> List[Dict]:
+        if field not in INDEX_CONFIG['fields'].get(table, ()):
+            raise ValueError(f"{table}.{field} is not indexed, add it to INDEX_CONFIG['fields']")
+        
+        start_time = time.time()
+        self.latency.start()
+        index_key = self._generate_cache_key(table, index_suffix(field, value))
+        
+        try:
+            # the index only holds ids, the rows themselves come from the normal per-row cache
+            with self.latency.timed('redis'):
+                cached_ids = self.cache_client.get(index_key)
+            
+            if cached_ids is not None:
+                self.stats.incr('index_hits')
+                ids = self.serializer.loads(cached_ids)
+            else:
+                self.stats.incr('index_misses')
+                # a write between our select and the fill would delete the index key before we set the old ids,
+                # every write bumps the query generation too, so the fill only happens if it hasn't moved
+                generation_key = QUERY_GENERATION_KEY.format(table=table)
+                with self.latency.timed('redis'):
+                    generation = int(self.redis_client.get(generation_key) or 0)
+                with self.latency.timed('sqlite'), self.readers.connection() as conn:
+                    cursor = conn.execute(f"SELECT id FROM {table} WHERE {field} = ? ORDER BY id", (value,))
+                    ids = [row[0] for row in cursor.fetchall()]
+                self._cache_ids(index_key, ids, DEMO_CONFIG['cache_ttl'], (generation_key, generation))
+            
+            rows, _ = self._fetch_many(table, ids)
+            # a write that changes the field only knows the new value, so rows that moved away are caught here
+            matching = [row for row in rows if row is not None and str(row.get(field)) == str(value)]
+            if len(matching) < len(ids) and cached_ids is not None:
+                with self.latency.timed('redis'):
+                    self.cache_client.delete(index_key)
+            
+            self._log_performance('read_by', time.time() - start_time, cached_ids is not None)
+            return matching
+            
+        except Exception as e:
+            print(f"Error during get_by operation: {e}")
+            return []
+    
+    def query(self, table: str, where: str, params: Tuple = (), order_by: str = 'id') -> List[Dict]:
+        # where and order_by are sql written by the caller, values go in params.
+        # any write to the table bumps its query generation, so every cached result for it is dropped at once
+        start_time = time.time()
+        self.latency.start()
+        
+        try:
+            with self.latency.timed('redis'):
+                generation = int(self.redis_client.get(QUERY_GENERATION_KEY.format(table=table)) or 0)
+            digest = hashlib.sha1(json.dumps([where, list(params), order_by], default=str).encode('utf-8')).hexdigest()
+            result_key = self._generate_cache_key(table, f"q{generation}:{digest}")
+            
+            with self.latency.timed('redis'):
+                cached_ids = self.cache_client.get(result_key)
+            
+            if cached_ids is not None:
+                self.stats.incr('query_hits')
+                ids = self.serializer.loads(cached_ids)
+            else:
+                self.stats.incr('query_misses')
+                with self.latency.timed('sqlite'), self.readers.connection() as conn:
+                    cursor = conn.execute(f"SELECT id FROM {table} WHERE {where} ORDER BY {order_by}", params)
+                    ids = [row[0] for row in cursor.fetchall()]
+                # a write that lands after we read the generation caches nothing stale, it moved to a new generation
+                self._cache_ids(result_key, ids, INDEX_CONFIG['query_ttl'])
+            
+            rows, _ = self._fetch_many(table, ids)
+            self._log_performance('query', time.time() - start_time, cached_ids is not None)
+            return [row for row in rows if row is not None]
+            
+        except Exception as e:
+            print(f"Error during query operation: {e}")
+            return []
+    
+    def _cache_ids(self, cache_key: str, ids: List[int], ttl: int, guard: Optional[Tuple[str, int]] = None):
+        # guard is (generation key, generation read before the select), the ids are dropped if it changed since
+        if len(ids) > INDEX_CONFIG['max_ids']:
+            return
+        
+        # an empty result is a negative entry, keep it as short as any other
+        ttl = ttl if ids else min(ttl, DEMO_CONFIG['negative_cache_ttl'])
+        with self.latency.timed('redis'):
+            if guard:
+                self._fill_if_generation_script(keys=[guard[0], cache_key], args=[guard[1], ttl, self.serializer.dumps(ids)])
+            else:
+                self.cache_client.setex(cache_key, ttl, self.serializer.dumps(ids))
+    
+    def _invalidate_indexes(self, pipe, table: str, rows: List[Dict]):
+        index_keys = [self._generate_cache_key(table, suffix) for suffix in index_suffixes(table, rows)]
+        if index_keys:
+            pipe.delete(*index_keys)
+        pipe.incr(QUERY_GENERATION_KEY.format(table=table))
+    
+    def get_fields(self, table: str, key: Union[str, int], fields: List[str]) -> Optional[Dict]:
+        # just these columns of one row, None if the row doesn't exist
+        if table not in self.hash_tables:
+            data = self.get(table, key)
+            return {field: data.get(field) for field in fields} if data is not None else None
+        
+        start_time = time.time()
+        self.latency.start()
+        cache_key = self._generate_cache_key(table, key)
+        
+        try:
+            self.ttl_policy.record_access(cache_key)
+            found, data = self._l1_get(cache_key)
+            if not found:
+                # id and the missing marker tell a whole cached row apart from one we know nothing about
+                with self.latency.timed('redis'):
+                    values = self.cache_client.hmget(cache_key, ['id', MISSING_FIELD, *fields])
+                row_id, missing, values = values[0], values[1], values[2:]
+                found = row_id is not None or missing is not None
+                if found and missing is None:
+                    raw = {field.encode('utf-8'): value for field, value in zip(fields, values) if value is not None}
+                    data = decode_fields(raw, self._column_converters(table))
+            
+            self.stats.incr('cache_hits' if found else 'cache_misses')
+            self.stats.incr('total_reads')
+            if not found:
+                data = self._load_coalesced(table, key, cache_key)
+            
+            self._log_performance('read', time.time() - start_time, found, table, key)
+            return {field: data.get(field) for field in fields} if data is not None else None
+            
+        except Exception as e:
+            print(f"Error during get_fields operation: {e}")
+            return None
+    
+    def update_fields(self, table: str, key: Union[str, int], changes: Dict) -> bool:
+        # UPDATE just these columns, hash rows are patched in place, string rows are dropped from the cache
+        if not changes or 'id' in changes:
+            raise ValueError("update_fields needs at least one column to change, and can't change id")
+        
+        start_time = time.time()
+        self.latency.start()
+        cache_key = self._generate_cache_key(table, key)
+        columns = list(changes)
+        
+        try:
+            if self.write_behind:
+                # goes through the stream like every other write so it can't overtake one queued before it
+                if not self._wait_for_room(1):
+                    return False
+                pipe = self.cache_client.pipeline(transaction=True)
+                pipe.xadd(WRITE_BEHIND_CONFIG['stream_key'], {
+                    'table': table,
+                    'id': key,
+                    'op': 'update',
+                    'data': json.dumps(changes, default=str)
+                })
+                self._stage_field_update(pipe, table, cache_key, changes)
+                self._invalidate(pipe, [cache_key])
+                self._invalidate_indexes(pipe, table, [changes])
+                pipe.xlen(WRITE_BEHIND_CONFIG['stream_key'])
+                with self.latency.timed('redis'):
+                    queue_depth = pipe.execute()[-1]
+                with self._queue_cond:
+                    self._queue_depth = queue_depth
+            else:
+                with self.write_lock:
+                    with self.latency.timed('sqlite'):
+                        try:
+                            cursor = self.sqlite_conn.execute(
+                                update_sql(table, tuple(columns)), [changes[column] for column in columns] + [key]
+                            )
+                        except sqlite3.IntegrityError as e:
+                            self.sqlite_conn.rollback()
+                            print(f"[ERROR] {table} {key} update rejected: {e}")
+                            return False
+                        if cursor.rowcount == 0:
+                            self.sqlite_conn.rollback()
+                            print(f"[ERROR] {table} {key} not found, nothing updated")
+                            return False
+                        self.sqlite_conn.commit()
+                    
+                    pipe = self.cache_client.pipeline(transaction=False)
+                    self._stage_field_update(pipe, table, cache_key, changes)
+                    self._invalidate(pipe, [cache_key])
+                    self._invalidate_indexes(pipe, table, [changes])
+                    with self.latency.timed('redis'):
+                        pipe.execute()
+            
+            self.stats.incr('total_writes')
+            self._log_performance('write', time.time() - start_time, True, table, key)
+            return True
+            
+        except Exception as e:
+            print(f"Error during update_fields operation: {e}")
+            return False
+    
+    def _stage_field_update(self, pipe, table: str, cache_key: str, changes: Dict):
+        if table in self.hash_tables:
+            self._hash_update_script(keys=[cache_key], args=update_args(changes), client=pipe)
+        else:
+            pipe.delete(cache_key)
+    
     def set(self, table: str, data: Dict, key_field: str = 'id') -> bool:
+        if self.write_behind:
+            return self._enqueue_writes(table, [data], key_field, 'write') == 1
+        
         start_time = time.time()
+        self.latency.start()
         
         try:
             with self.write_lock:
@@ -166,54 +920,42 @@ class WriteThoughCacheManager:
                 
                 db_data = data.copy()
                 
-                if table == 'users' and 'username' in db_data:
-                    print(f"[DEBUG] Attempting to insert user: {db_data['username']}")
-                
                 if key_field in db_data and (db_data[key_field] is None or db_data[key_field] == ''):
                     del db_data[key_field]
                 
                 if 'id' in db_data and key_field != 'id':
                     del db_data['id']
                 
-                columns = list(db_data.keys())
-                placeholders = ['?' for _ in columns]
+                columns = tuple(db_data.keys())
                 values = [db_data[col] for col in columns]
                 
-                query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(placeholders)})"
-                
-                if table == 'users':
-                    print(f"[DEBUG] SQL Query: {query}")
-                    print(f"[DEBUG] Values: {values[:2]}...")  # first 2 values only
-                    
-                    if 'username' in db_data:
-                        cursor.execute("SELECT COUNT(*) FROM users WHERE username = ?", (db_data['username'],))
-                        existing_count = cursor.fetchone()[0]
-                        if existing_count > 0:
-                            print(f"[ERROR] Username {db_data['username']} already exists in database!")
-                            cursor.execute("SELECT username FROM users LIMIT 5")
-                            existing_users = cursor.fetchall()
-                            print(f"[DEBUG] Current usernames in DB: {[user[0] for user in existing_users]}")
-                            return False
-                
-                cursor.execute(query, values)
-                
-                record_id = cursor.lastrowid
-                
-                self.sqlite_conn.commit()
+                with self.latency.timed('sqlite'):
+                    record_id = insert_row(cursor, table, columns, values)
+                    if record_id is None:
+                        self.sqlite_conn.rollback()
+                    else:
+                        self.sqlite_conn.commit()
+                if record_id is None:
+                    print(f"[ERROR] {table} row conflicts with an existing one (UNIQUE constraint), not written")
+                    return False
                 
                 # put in cache too (don't modify original)
                 cache_data = data.copy()
                 cache_data[key_field] = record_id
                 
                 cache_key = self._generate_cache_key(table, record_id)
-                self.redis_client.setex(
-                    cache_key,
-                    DEMO_CONFIG['cache_ttl'],
-                    json.dumps(cache_data, default=str)
-                )
+                if self.use_scripts:
+                    self._write_rows(table, [(cache_key, cache_data)])
+                else:
+                    pipe = self.cache_client.pipeline(transaction=False)
+                    self._stage_row(pipe, table, cache_key, cache_data, self.ttl_policy.ttl_for(cache_key))
+                    self._invalidate(pipe, [cache_key])
+                    self._invalidate_indexes(pipe, table, [cache_data])
+                    with self.latency.timed('redis'):
+                        pipe.execute()
                 
-                self.stats['total_writes'] += 1
-                self._log_performance('write', time.time() - start_time, True)
+                self.stats.incr('total_writes')
+                self._log_performance('write', time.time() - start_time, True, table, record_id)
                 
                 return True
                 
@@ -222,109 +964,470 @@ class WriteThoughCacheManager:
             return False
     
     def batch_write(self, table: str, data_list: List[Dict]) -> int:
+        if self.write_behind:
+            return self._enqueue_writes(table, data_list, 'id', 'batch_write')
+        
         start_time = time.time()
+        self.latency.start()
         successful_writes = 0
         
         try:
-            with self.write_lock:
-                cursor = self.sqlite_conn.cursor()
-                
-                for data in data_list:
-                    try:
-                        db_data = data.copy()
-                        
-                        if 'id' in db_data and (db_data['id'] is None or db_data['id'] == ''):
-                            del db_data['id']
-                        
-                        if 'id' in db_data:
-                            del db_data['id']
-                        
-                        columns = list(db_data.keys())
-                        placeholders = ['?' for _ in columns]
-                        values = [db_data[col] for col in columns]
-                        
-                        query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(placeholders)})"
-                        cursor.execute(query, values)
-                        
-                        record_id = cursor.lastrowid
-                        
-                        cache_data = data.copy()
-                        cache_data['id'] = record_id
-                        
-                        cache_key = self._generate_cache_key(table, record_id)
-                        self.redis_client.setex(
-                            cache_key,
-                            DEMO_CONFIG['cache_ttl'],
-                            json.dumps(cache_data, default=str)
-                        )
-                        
-                        successful_writes += 1
-                        
-                    except Exception as e:
-                        print(f"Error writing record: {e}")
-                        continue
-                
-                self.sqlite_conn.commit()
-                
-                self.stats['total_writes'] += successful_writes
-                self.stats['batch_writes'] += 1
-                self._log_performance('batch_write', time.time() - start_time, True)
-                
-                return successful_writes
+            with self.write_lock, self.latency.timed('sqlite'):
+                written = insert_rows(self.sqlite_conn, table, data_list)
+            successful_writes = len(written)
+            
+            cache_entries = [(self._generate_cache_key(table, cache_data['id']), cache_data) for cache_data in written]
+            # cache is filled after the commit and outside the lock, one pipeline per chunk
+            self._cache_many(table, cache_entries, invalidate=True)
+            
+            self.stats.incr('total_writes', successful_writes)
+            self.stats.incr('batch_writes')
+            self._log_performance('batch_write', time.time() - start_time, True)
+            
+            return successful_writes
                 
         except Exception as e:
             print(f"Error during batch write: {e}")
             return successful_writes
     
-    def _log_performance(self, operation_type: str, execution_time: float, cache_used: bool):
+    def _cache_many(self, table: str, entries: List, invalidate: bool = False):
+        chunk_size = DEMO_CONFIG['pipeline_chunk_size']
+        for i in range(0, len(entries), chunk_size):
+            chunk = entries[i:i + chunk_size]
+            if invalidate and self.use_scripts:
+                self._write_rows(table, chunk)
+                continue
+            
+            pipe = self.cache_client.pipeline(transaction=False)
+            for cache_key, cache_data in chunk:
+                # admission control is only for read backfills, a write must replace what's cached
+                if not invalidate and cache_data is not None and not self.ttl_policy.admit(cache_key):
+                    continue
+                ttl = self.ttl_policy.ttl_for(cache_key) if cache_data is not None else DEMO_CONFIG['negative_cache_ttl']
+                size = self._stage_row(pipe, table, cache_key, cache_data, ttl)
+                if not invalidate:
+                    self._l1_set(cache_key, cache_data, size, ttl)
+            if invalidate:
+                self._invalidate(pipe, [cache_key for cache_key, _ in chunk])
+                self._invalidate_indexes(pipe, table, [cache_data for _, cache_data in chunk])
+            with self.latency.timed('redis'):
+                pipe.execute()
+    
+    def _write_rows(self, table: str, entries: List[Tuple[str, Dict]]):
+        # one EVALSHA for the whole chunk, see WRITE_ROWS_SCRIPT. only the l1 of this process is dropped here,
+        # the script publishes the keys for everyone else
+        cache_keys = [cache_key for cache_key, _ in entries]
+        message = None
+        if self.l1:
+            for cache_key in cache_keys:
+                self.l1.invalidate(cache_key)
+            message = {'origin': self._instance_id, 'keys': cache_keys}
+        
+        rows = [(cache_key, cache_data, self.ttl_policy.ttl_for(cache_key)) for cache_key, cache_data in entries]
+        index_keys = [
+            self._generate_cache_key(table, suffix)
+            for suffix in index_suffixes(table, [cache_data for _, cache_data in entries])
+        ]
+        keys, args = write_rows_args(
+            table, rows, index_keys, QUERY_GENERATION_KEY.format(table=table), SCRIPT_CONFIG['stats_key'],
+            self.serializer, table in self.hash_tables, L1_CONFIG['channel'] if self.l1 else None, message
+        )
+        with self.latency.timed('redis'):
+            self._write_rows_script(keys=keys, args=args)
+    
+    def _start_write_behind(self):
         try:
-            cursor = self.sqlite_conn.cursor()
-            cursor.execute(
-                "INSERT INTO performance_log (operation_type, execution_time, cache_used) VALUES (?, ?, ?)",
-                (operation_type, execution_time, cache_used)
+            self.redis_client.xgroup_create(
+                WRITE_BEHIND_CONFIG['stream_key'], WRITE_BEHIND_CONFIG['group'], id='0', mkstream=True
             )
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        
+        self._seed_id_script = self.redis_client.register_script(SEED_ID_SCRIPT)
+        self._queue_depth = self.redis_client.xlen(WRITE_BEHIND_CONFIG['stream_key'])
+        self._flusher_stop.clear()
+        self._flusher = threading.Thread(target=self._flusher_loop, name='write-behind-flusher', daemon=True)
+        self._flusher.start()
+        print(f"Write-behind mode on, flushing {WRITE_BEHIND_CONFIG['stream_key']} to SQLite")
+    
+    def _next_ids(self, table: str, count: int) -> List[int]:
+        if count == 0:
+            return []
+        
+        counter_key = f"writebehind:seq:{table}"
+        if table not in self._seeded_tables:
+            with self.readers.connection() as conn:
+                max_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+                seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = ?", (table,))
+                max_id = max(max_id, seq.fetchone()[0])
+            self._seed_id_script(keys=[counter_key], args=[max_id])
+            self._seeded_tables.add(table)
+        
+        last_id = self.redis_client.incrby(counter_key, count)
+        return list(range(last_id - count + 1, last_id + 1))
+    
+    def _wait_for_room(self, count: int) -> bool:
+        # backpressure, writers wait while the flusher is too far behind
+        with self._queue_cond:
+            has_room = self._queue_cond.wait_for(
+                lambda: self._queue_depth < WRITE_BEHIND_CONFIG['max_pending'],
+                WRITE_BEHIND_CONFIG['block_timeout']
+            )
+        if not has_room:
+            print(f"Write-behind queue is full ({self._queue_depth} pending), rejecting {count} writes")
+        return has_room
+    
+    def _enqueue_writes(self, table: str, data_list: List[Dict], key_field: str, operation_type: str) -> int:
+        start_time = time.time()
+        if not data_list:
+            return 0
+        self.latency.start()
+        
+        try:
+            if not self._wait_for_room(len(data_list)):
+                return 0
+            
+            with self.latency.timed('redis'):
+                new_ids = iter(self._next_ids(table, sum(1 for data in data_list if data.get(key_field) in (None, ''))))
+            
+            pipe = self.cache_client.pipeline(transaction=True)
+            cache_keys = []
+            cache_rows = []
+            for data in data_list:
+                record_id = data.get(key_field)
+                if record_id in (None, ''):
+                    record_id = next(new_ids)
+                
+                db_data = {col: value for col, value in data.items() if col not in ('id', key_field)}
+                cache_data = data.copy()
+                cache_data[key_field] = record_id
+                
+                cache_key = self._generate_cache_key(table, record_id)
+                cache_keys.append(cache_key)
+                cache_rows.append(cache_data)
+                self._stage_row(pipe, table, cache_key, cache_data, self.ttl_policy.ttl_for(cache_key))
+                pipe.xadd(WRITE_BEHIND_CONFIG['stream_key'], {
+                    'table': table,
+                    'id': record_id,
+                    'data': json.dumps(db_data, default=str)
+                })
+            self._invalidate(pipe, cache_keys)
+            self._invalidate_indexes(pipe, table, cache_rows)
+            pipe.xlen(WRITE_BEHIND_CONFIG['stream_key'])
+            with self.latency.timed('redis'):
+                queue_depth = pipe.execute()[-1]
+            
+            with self._queue_cond:
+                self._queue_depth = queue_depth
+            
+            self.stats.incr('total_writes', len(data_list))
+            if operation_type == 'batch_write':
+                self.stats.incr('batch_writes')
+            if operation_type == 'write':
+                self._log_performance(operation_type, time.time() - start_time, True, table, cache_rows[0][key_field])
+            else:
+                self._log_performance(operation_type, time.time() - start_time, True)
+            
+            return len(data_list)
+            
+        except Exception as e:
+            print(f"Error queueing writes: {e}")
+            return 0
+    
+    def _flusher_loop(self):
+        stream_key = WRITE_BEHIND_CONFIG['stream_key']
+        # entries delivered to this consumer but never acked (crash, sqlite error) get replayed first
+        replaying = True
+        
+        next_claim = 0
+        
+        while not self._flusher_stop.is_set():
+            try:
+                # entries left pending by a consumer that died and never came back are taken over once idle
+                if not replaying and time.time() >= next_claim:
+                    next_claim = time.time() + WRITE_BEHIND_CONFIG['claim_idle'] / 2
+                    if self._claim_idle_entries():
+                        next_claim = 0
+                        continue
+                
+                response = self.redis_client.xreadgroup(
+                    WRITE_BEHIND_CONFIG['group'],
+                    self._consumer,
+                    {stream_key: '0' if replaying else '>'},
+                    count=DEMO_CONFIG['write_batch_size'],
+                    block=None if replaying else int(WRITE_BEHIND_CONFIG['flush_interval'] * 1000)
+                )
+                entries = response[0][1] if response else []
+                
+                if entries:
+                    self._flush_entries(entries, replay=replaying)
+                else:
+                    replaying = False
+                    with self._queue_cond:
+                        self._queue_depth = self.redis_client.xlen(stream_key)
+                        self._queue_cond.notify_all()
+                    
+            except Exception as e:
+                print(f"Error in write-behind flusher: {e}")
+                replaying = True
+                self._flusher_stop.wait(WRITE_BEHIND_CONFIG['flush_interval'])
+    
+    def _claim_idle_entries(self) -> bool:
+        # XAUTOCLAIM moves entries idle for claim_idle to us, they may have reached sqlite already so they're replays
+        stream_key = WRITE_BEHIND_CONFIG['stream_key']
+        claimed = self.redis_client.xautoclaim(
+            stream_key, WRITE_BEHIND_CONFIG['group'], self._consumer,
+            int(WRITE_BEHIND_CONFIG['claim_idle'] * 1000), count=DEMO_CONFIG['write_batch_size']
+        )[1]
+        # redis before 7 hands back entries deleted from the stream without their fields, they only need an ack
+        gone = [entry_id for entry_id, fields in claimed if not fields]
+        if gone:
+            self.redis_client.xack(stream_key, WRITE_BEHIND_CONFIG['group'], *gone)
+        entries = [(entry_id, fields) for entry_id, fields in claimed if fields]
+        if entries:
+            print(f"Write-behind flusher claimed {len(entries)} idle entries from other consumers")
+            self._flush_entries(entries, replay=True)
+        return bool(claimed)
+    
+    def _flush_entries(self, entries: List, replay: bool = False):
+        # runs of consecutive entries with the same shape share one executemany, but runs stay in stream order
+        # so two writes to the same id always land in the order they were queued.
+        # replay is for entries delivered before, those may already be in sqlite and are upserted, a fresh insert
+        # that hits an existing id is refused like the sync set refuses it
+        runs = []
+        flushed = {}
+        for entry_id, fields in entries:
+            db_data = json.loads(fields['data'])
+            db_data['id'] = int(fields['id'])
+            flushed.setdefault(fields['table'], []).append(db_data)
+            columns = tuple(db_data.keys())
+            shape = (fields['table'], columns, fields.get('op', 'insert'))
+            if not runs or runs[-1][0] != shape:
+                runs.append((shape, []))
+            runs[-1][1].append((entry_id, fields, [db_data[col] for col in columns]))
+        
+        dead_letters = []
+        updated_keys = []
+        with self.write_lock:
+            cursor = self.sqlite_conn.cursor()
+            if not self.sqlite_conn.in_transaction:
+                cursor.execute("BEGIN")
+            
+            for (table, columns, op), rows in runs:
+                if op == 'update':
+                    # update_fields, a partial upsert would trip NOT NULL on the columns it doesn't carry
+                    changed = tuple(col for col in columns if col != 'id')
+                    for entry_id, fields, values in rows:
+                        try:
+                            cursor.execute(
+                                update_sql(table, changed),
+                                [value for col, value in zip(columns, values) if col != 'id'] + [int(fields['id'])]
+                            )
+                            updated = cursor.rowcount > 0
+                        except sqlite3.IntegrityError:
+                            updated = False
+                        if updated:
+                            updated_keys.append(self._generate_cache_key(table, fields['id']))
+                        else:
+                            dead_letters.append((table, fields))
+                    continue
+                
+                # upsert on id so replaying an entry that already made it to sqlite is harmless
+                query = upsert_sql(table, columns) if replay else insert_sql(table, columns)
+                for (entry_id, fields, _), record_id in zip(rows, insert_group(cursor, query, rows)):
+                    if record_id is None:
+                        dead_letters.append((table, fields))
+            
             self.sqlite_conn.commit()
-        except Exception:
-            pass
+        
+        pipe = self.redis_client.pipeline(transaction=False)
+        for table, fields in dead_letters:
+            # sqlite refused it, so the cached copy is a lie, park it for a human to look at
+            pipe.lpush(WRITE_BEHIND_CONFIG['dead_letter_key'], json.dumps(fields))
+            pipe.delete(self._generate_cache_key(table, fields['id']))
+        if dead_letters:
+            self._invalidate(pipe, [self._generate_cache_key(table, fields['id']) for table, fields in dead_letters])
+        # an update only patched (or dropped) the cached row, a read before this flush could have cached
+        # the old row again from sqlite, so drop it now that sqlite has the new values
+        if updated_keys:
+            pipe.delete(*updated_keys)
+            self._invalidate(pipe, updated_keys)
+        # readers may have rebuilt an index from sqlite before these rows got there
+        for table, rows in flushed.items():
+            self._invalidate_indexes(pipe, table, rows)
+        entry_ids = [entry_id for entry_id, _ in entries]
+        pipe.xack(WRITE_BEHIND_CONFIG['stream_key'], WRITE_BEHIND_CONFIG['group'], *entry_ids)
+        pipe.xdel(WRITE_BEHIND_CONFIG['stream_key'], *entry_ids)
+        pipe.xlen(WRITE_BEHIND_CONFIG['stream_key'])
+        queue_depth = pipe.execute()[-1]
+        
+        with self._queue_cond:
+            self._queue_depth = queue_depth
+            self._queue_cond.notify_all()
+    
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        if not self._flusher:
+            return True
+        
+        with self._queue_cond:
+            return self._queue_cond.wait_for(lambda: self._queue_depth == 0, timeout)
+    
+    def _log_performance(self, operation_type: str, execution_time: float, cache_used: bool,
+                         table: Optional[str] = None, key: Optional[Union[str, int]] = None):
+        if operation_type == 'read':
+            self.latency.finish('read_hit' if cache_used else 'read_miss', execution_time)
+        else:
+            self.latency.finish(operation_type, execution_time)
+        
+        # hot path only appends to memory, the perf-log thread does the sqlite insert in batches
+        sample_rate = PERF_LOG_CONFIG['sample_rate']
+        if sample_rate < 1.0 and random.random() >= sample_rate:
+            return
+        if len(self._perf_buffer) >= PERF_LOG_CONFIG['max_queued']:
+            self._perf_dropped += 1
+            return
+        
+        # same format as CURRENT_TIMESTAMP, so rows look like they did when inserted inline
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        # single-row operations keep the row, the preloader warms the cache from recent ones
+        self._perf_buffer.append((operation_type, execution_time, cache_used, timestamp, table, key))
+    
+    def _perf_log_loop(self):
+        while not self._perf_stop.wait(PERF_LOG_CONFIG['flush_interval']):
+            self.flush_performance_log()
+    
+    def flush_performance_log(self):
+        while self._perf_buffer:
+            batch = []
+            try:
+                while len(batch) < PERF_LOG_CONFIG['flush_batch_size']:
+                    batch.append(self._perf_buffer.popleft())
+            except IndexError:
+                pass
+            
+            try:
+                with self.write_lock:
+                    self.sqlite_conn.executemany(
+                        "INSERT INTO performance_log (operation_type, execution_time, cache_used, timestamp, table_name, record_key) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        batch
+                    )
+                    self.sqlite_conn.commit()
+            except Exception as e:
+                print(f"Warning: dropped {len(batch)} performance log entries: {e}")
     
     def get_cache_stats(self) -> Dict:
-        total_reads = self.stats['total_reads']
-        hit_ratio = (self.stats['cache_hits'] / total_reads * 100) if total_reads > 0 else 0
+        counters = self.stats.snapshot()
+        total_reads = counters['total_reads']
+        hit_ratio = (counters['cache_hits'] / total_reads * 100) if total_reads > 0 else 0
         
-        return {
-            'cache_hits': self.stats['cache_hits'],
-            'cache_misses': self.stats['cache_misses'],
+        stats = {
+            'cache_hits': counters['cache_hits'],
+            'cache_misses': counters['cache_misses'],
             'total_reads': total_reads,
-            'total_writes': self.stats['total_writes'],
-            'batch_writes': self.stats['batch_writes'],
-            'hit_ratio_percent': hit_ratio
+            'total_writes': counters['total_writes'],
+            'batch_writes': counters['batch_writes'],
+            'hit_ratio_percent': hit_ratio,
+            'coalesced_loads': counters['coalesced_loads'],
+            'lease_waits': counters['lease_waits'],
+            'early_refreshes': counters['early_refreshes'],
+            'index_hits': counters['index_hits'],
+            'index_misses': counters['index_misses'],
+            'query_hits': counters['query_hits'],
+            'query_misses': counters['query_misses'],
+            'perf_log_queued': len(self._perf_buffer),
+            'perf_log_dropped': self._perf_dropped
         }
+        
+        if self.l1:
+            stats.update(self.l1.get_stats())
+        stats.update(self.ttl_policy.get_stats())
+        if self.use_scripts:
+            # counted by the write script, so these include every process writing through it
+            written = self.redis_client.hgetall(SCRIPT_CONFIG['stats_key'])
+            stats['writes_by_table'] = {table: int(count) for table, count in written.items()}
+        
+        # per operation, per backend: count, mean and p50/p95/p99/p999/max in ms
+        stats['latency'] = self.latency.snapshot()
+        return stats
+    
+    def export_prometheus(self) -> str:
+        stats = self.get_cache_stats()
+        gauges = {
+            name: value for name, value in stats.items()
+            if name not in STAT_NAMES and isinstance(value, (int, float))
+        }
+        return render_prometheus(METRICS_CONFIG['prefix'], self.stats.snapshot(), gauges, self.latency)
     
     def clear_cache(self):
         try:
-            # clear all demo-related keys
-            keys = self.redis_client.keys("users:*")
-            keys.extend(self.redis_client.keys("products:*"))
-            keys.extend(self.redis_client.keys("demo:*"))
-            
-            if keys:
-                self.redis_client.delete(*keys)
-            
-            self.stats = {
-                'cache_hits': 0,
-                'cache_misses': 0,
-                'total_reads': 0,
-                'total_writes': 0,
-                'batch_writes': 0
-            }
+            if NAMESPACE_CONFIG['mode'] == 'generation':
+                # O(1) per table, the old generation is never read again and expires on its own ttl
+                pipe = self.redis_client.pipeline(transaction=False)
+                for table in NAMESPACE_CONFIG['tables']:
+                    pipe.incr(f"{NAMESPACE_CONFIG['generation_prefix']}{table}")
+                for table, generation in zip(NAMESPACE_CONFIG['tables'], pipe.execute()):
+                    self._generations[table] = (generation, time.time())
+            else:
+                patterns = [f"{table}:*" for table in NAMESPACE_CONFIG['tables']] + ["demo:*"]
+                for pattern in patterns:
+                    self._unlink_matching(pattern)
+            
+            pipe = self.redis_client.pipeline(transaction=False)
+            self._invalidate(pipe, '*')
+            pipe.delete(SCRIPT_CONFIG['stats_key'])
+            pipe.execute()
+            
+            self.stats.reset()
+            self.latency.reset()
             
         except Exception as e:
             print(f"Error clearing cache: {e}")
     
+    def _unlink_matching(self, pattern: str):
+        # SCAN walks the keyspace a little at a time and UNLINK frees memory off the main thread,
+        # so other clients keep getting served while a big flush runs
+        chunk_size = DEMO_CONFIG['pipeline_chunk_size']
+        batch = []
+        for key in self.redis_client.scan_iter(match=pattern, count=NAMESPACE_CONFIG['scan_count']):
+            batch.append(key)
+            if len(batch) >= chunk_size:
+                self.redis_client.unlink(*batch)
+                batch = []
+        if batch:
+            self.redis_client.unlink(*batch)
+    
     def close(self):
         try:
+            if self._metrics_server:
+                self._metrics_server.shutdown()
+                self._metrics_server.server_close()
+                self._metrics_server = None
+            if self._flusher:
+                if not self.flush(WRITE_BEHIND_CONFIG['close_timeout']):
+                    print(f"Warning: closing with {self._queue_depth} writes still queued, they will replay on restart")
+                self._flusher_stop.set()
+                self._flusher.join()
+                self._flusher = None
+            if self._perf_flusher:
+                self._perf_stop.set()
+                self._perf_flusher.join()
+                self._perf_flusher = None
+                self.flush_performance_log()
+            if self._pubsub_thread:
+                self._pubsub_thread.stop()
+                self._pubsub_thread = None
+                self._pubsub.close()
             if self.redis_client:
                 self.redis_client.close()
+            if self.cache_client:
+                self.cache_client.close()
+            if self.redis_pool:
+                self.redis_pool.disconnect()
+            if self.cache_pool:
+                self.cache_pool.disconnect()
+            self.readers.close()
             if self.sqlite_conn:
                 self.sqlite_conn.close()
         except Exception as e:
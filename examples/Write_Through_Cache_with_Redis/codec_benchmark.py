@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import json
+import random
+import time
+from typing import Callable, Dict, List, Tuple
+
+import click
+from tabulate import tabulate
+
+from serialization import CacheSerializer
+
+
+def generate_users(count: int) -> List[Dict]:
+    # same shape as the rows the demo caches for the users table
+    users = []
+    for i in range(count):
+        users.append({
+            'id': i + 1,
+            'username': f'student_{i:05d}',
+            'email': f'student{i:05d}@university.edu',
+            'created_at': '2024-01-15 10:30:00',
+            'profile_data': json.dumps({
+                'age': random.randint(18, 25),
+                'major': random.choice(['Computer Science', 'Business', 'Engineering', 'Art', 'Math']),
+                'year': random.choice(['Freshman', 'Sophomore', 'Junior', 'Senior']),
+                'preferences': {
+                    'study_group': random.choice([True, False]),
+                    'theme': random.choice(['light', 'dark'])
+                }
+            })
+        })
+    return users
+
+
+def generate_products(count: int) -> List[Dict]:
+    categories = ['Laptops', 'Textbooks', 'Supplies', 'Food', 'Software']
+    products = []
+    for i in range(count):
+        products.append({
+            'id': i + 1,
+            'name': f'Campus_Item_{i:05d}',
+            'price': round(random.uniform(5.0, 500.0), 2),
+            'category': random.choice(categories),
+            'description': f'Essential campus item #{i:05d}',
+            'stock_quantity': random.randint(0, 50)
+        })
+    return products
+
+
+def measure(rows: List[Dict], encode: Callable, decode: Callable, rounds: int) -> Dict:
+    encoded = [encode(row) for row in rows]
+    
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for row in rows:
+            encode(row)
+    encode_time = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for payload in encoded:
+            decode(payload)
+    decode_time = time.perf_counter() - start
+    
+    operations = len(rows) * rounds
+    return {
+        'avg_bytes': sum(len(payload) for payload in encoded) / len(encoded),
+        'encode_us': encode_time / operations * 1e6,
+        'decode_us': decode_time / operations * 1e6
+    }
+
+
+def candidates(threshold: int) -> Dict[str, Tuple[Callable, Callable]]:
+    # the pre-codec format: a json str that redis-py utf-8 decodes on every hit
+    options = {
+        'legacy json (str)': (
+            lambda row: json.dumps(row, default=str).encode('utf-8'),
+            lambda payload: json.loads(payload.decode('utf-8'))
+        )
+    }
+    
+    for codec in ('json', 'msgpack'):
+        for compression in (None, 'zlib', 'lz4'):
+            name = codec if compression is None else f'{codec} + {compression}'
+            try:
+                serializer = CacheSerializer(codec, compression, threshold)
+            except ValueError as e:
+                print(f"[INFO] Skipping {name}: {e}")
+                continue
+            options[name] = (serializer.dumps, serializer.loads)
+    return options
+
+
+@click.command()
+@click.option('--rows', default=2000, help='Rows generated per table')
+@click.option('--rounds', default=5, help='Times every row is encoded and decoded')
+@click.option('--threshold', default=0, help='compress_threshold passed to the serializer (0 compresses everything)')
+def main(rows, rounds, threshold):
+    random.seed(42)
+    tables = {
+        'users': generate_users(rows),
+        'products': generate_products(rows)
+    }
+    
+    for table, data in tables.items():
+        results = [["Codec", "Avg bytes", "Size vs legacy", "Encode (us/row)", "Decode (us/row)"]]
+        baseline = None
+        for name, (encode, decode) in candidates(threshold).items():
+            result = measure(data, encode, decode, rounds)
+            baseline = baseline or result['avg_bytes']
+            results.append([
+                name,
+                f"{result['avg_bytes']:.1f}",
+                f"{result['avg_bytes'] / baseline * 100:.0f}%",
+                f"{result['encode_us']:.2f}",
+                f"{result['decode_us']:.2f}"
+            ])
+        
+        print(f"\n[PERF] {table.upper()} ({rows} rows x {rounds} rounds)")
+        print(tabulate(results, headers="firstrow", tablefmt="grid"))
+
+
+if __name__ == "__main__":
+    main()
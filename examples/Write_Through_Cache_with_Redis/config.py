@@ -1,4 +1,7 @@
 
+# DEBUG shows every SQL statement the cache manager runs
+LOG_LEVEL = 'INFO'
+
 REDIS_CONFIG = {
     'host': 'localhost',
     'port': 21083,
@@ -9,10 +12,21 @@ REDIS_CONFIG = {
     'retry_on_timeout': True
 }
 
+# pools shared by every thread, callers wait up to pool_timeout for a free connection. the sync manager has two,
+# text commands (stats, leases, stream) and binary cached rows, so it opens up to the sum of both sizes
+REDIS_POOL_CONFIG = {
+    'max_connections': 20,  # text client
+    'cache_max_connections': 30,  # binary client for cached rows, the asyncio manager's single pool gets both
+    'pool_timeout': 5
+}
+
 SQLITE_CONFIG = {
     'database_path': 'demo_database.db',
     'timeout': 20.0,
-    'check_same_thread': False
+    'check_same_thread': False,
+    'cache_size': 10000,  # pages, applied to the writer and to every pooled reader connection
+    'cached_statements': 256,  # prepared statements kept per connection
+    'reader_pool_size': 16  # read-only connections at most, a read waits up to timeout for a free one
 }
 
 DEMO_CONFIG = {
@@ -20,7 +34,129 @@ DEMO_CONFIG = {
     'batch_size': 100,
     'performance_iterations': 1000,
     'cache_ttl': 600,  # 10 min ttl, change as per need
-    'write_batch_size': 50
+    'negative_cache_ttl': 30,  # ids that don't exist are cached as null for this long
+    'write_batch_size': 50,
+    'pipeline_chunk_size': 500,  # max commands per redis pipeline round trip
+    'sql_in_chunk_size': 500  # ids per SELECT ... IN (...), stays under sqlite's variable limit
+}
+
+# write-behind: set/batch_write only touch redis, a background thread drains the stream into sqlite
+WRITE_BEHIND_CONFIG = {
+    'enabled': False,
+    'stream_key': 'writebehind:queue',
+    'group': 'sqlite_flusher',
+    'consumer': None,  # None names the consumer after the host and pid, a fixed name replays its own unacked entries
+    'claim_idle': 60.0,  # seconds an entry can sit unacked with any consumer before a live flusher claims it
+    'dead_letter_key': 'writebehind:dead',
+    'max_pending': 10000,  # writers block once this many entries are waiting for sqlite
+    'block_timeout': 5.0,  # seconds a writer waits for room before the write is rejected
+    'flush_interval': 0.5,
+    'close_timeout': 30.0
+}
+
+# performance_log rows are buffered in memory and written by a background thread
+PERF_LOG_CONFIG = {
+    'sample_rate': 1.0,  # fraction of operations that get logged
+    'max_queued': 10000,  # entries past this are dropped until the flusher catches up
+    'flush_interval': 1.0,
+    'flush_batch_size': 500
+}
+
+# optional in-process cache in front of redis, other workers are told about writes over pub/sub
+L1_CONFIG = {
+    'enabled': False,
+    'max_entries': 10000,
+    'max_bytes': 64 * 1024 * 1024,
+    'ttl': 30,  # seconds, never longer than the redis ttl of the same entry
+    'channel': 'cache:invalidate'
+}
+
+# what happens when a hot key expires and many readers miss at once
+STAMPEDE_CONFIG = {
+    'coalesce': True,  # concurrent misses for one key in this process share a single sqlite load
+    'wait_timeout': 10.0,  # seconds a coalesced reader waits for the loader
+    'lease': False,  # short redis lock so only one worker across processes rebuilds a key
+    'lease_ms': 2000,
+    'lease_wait': 0.5,  # seconds to wait for the lease holder before loading anyway
+    'lease_poll_interval': 0.02,
+    'xfetch': False,  # probabilistic early refresh, costs a PTTL in the same round trip as the GET
+    'xfetch_beta': 1.0  # > 1 refreshes earlier, < 1 later
+}
+
+# how cached rows are encoded, every entry starts with a tag byte so old and new formats can be read side by side
+CODEC_CONFIG = {
+    'codec': 'json',  # json or msgpack (needs the msgpack package)
+    'compression': None,  # None, zlib or lz4 (needs the lz4 package)
+    'compress_threshold': 512  # bytes, smaller values are stored uncompressed
+}
+
+# how clear_cache finds the cached rows
+NAMESPACE_CONFIG = {
+    'mode': 'scan',  # scan: SCAN + UNLINK every key, generation: bump a counter that is part of every cache key
+    'tables': ['users', 'products'],
+    'scan_count': 1000,  # keys the server looks at per SCAN call
+    'generation_prefix': 'ns:gen:',
+    'generation_refresh_interval': 1.0  # seconds before another process's flush is noticed
+}
+
+# how long cached rows live. 'fixed' gives every row cache_ttl, 'adaptive' counts reads per key in a
+# count-min sketch (per process) and picks the ttl, and whether a read miss is cached at all, from that
+TTL_POLICY_CONFIG = {
+    'policy': 'fixed',
+    'hot_ttl': 3600,  # keys read at least hot_threshold times recently
+    'hot_threshold': 8,
+    'cold_ttl': 60,  # keys read once
+    'admit_after': 2,  # reads before a read miss is cached, 1 caches every miss (writes are always cached)
+    'sliding': True,  # hot reads push the expiry out to hot_ttl (GETEX)
+    'sliding_sample': 0.1,  # fraction of hot reads that do, each one is a write in redis
+    'sketch_width': 65536,  # counters per row, a power of two
+    'sketch_depth': 4,
+    'sketch_reset_after': 655360  # reads between halving every count, so old popularity fades
+}
+
+# tables listed here are cached as a redis hash per row instead of one serialized string,
+# needed for get_fields/update_fields to touch single columns
+STORAGE_CONFIG = {
+    'hash_tables': []  # e.g. ['products']
+}
+
+# secondary lookups: get_by() only works on these fields, writes drop the matching index entries
+INDEX_CONFIG = {
+    'fields': {
+        'users': ['username', 'email'],
+        'products': ['category']
+    },
+    'query_ttl': 60,  # query() results, dropped on any write to the table anyway
+    'max_ids': 10000  # bigger result sets are returned but not cached
+}
+
+# preloader.py, fills the cache after a deploy or clear_cache
+PRELOAD_CONFIG = {
+    'chunk_size': 500,  # rows per SELECT and per redis pipeline
+    'rows_per_second': 5000,  # None for no limit, keeps sqlite and redis responsive for live traffic
+    'ttl_jitter': 0.1,  # preloaded keys get up to 10% less ttl so they don't all expire in the same second
+    'recent_window': 3600,  # seconds of performance_log to look at for --recent
+    'recent_limit': 10000,  # most used rows to preload from that window
+    'progress_interval': 2.0  # seconds between progress lines
+}
+
+# sync writes (set, batch_write) go through one lua script per call/chunk instead of a pipeline, so the row,
+# its index entries, the query generation and the l1 broadcast change together. False for the plain pipeline
+SCRIPT_CONFIG = {
+    'enabled': True,
+    'stats_key': 'demo:write_counts'  # hash of rows written per table, shared by every process
+}
+
+# AsyncWriteThroughCacheManager, redis pool sizes come from REDIS_POOL_CONFIG
+ASYNC_CONFIG = {
+    'sqlite_read_workers': 8  # threads running sqlite reads, also the size of its reader pool
+}
+
+# latency histograms are always kept, the prometheus endpoint only starts when http_port is set
+METRICS_CONFIG = {
+    'prefix': 'writethrough_cache',
+    'http_host': '127.0.0.1',
+    'http_port': None  # e.g. 9108, serves /metrics
 }
 
 ZOS_CONFIG = {
@@ -3,12 +3,13 @@
 import time
 import random
 import json
+import logging
 from typing import List, Dict
 from tabulate import tabulate
 import click
 
 from cache_manager import WriteThoughCacheManager
-from config import DEMO_CONFIG, REDIS_CONFIG
+from config import DEMO_CONFIG, REDIS_CONFIG, LOG_LEVEL
 
 
 class CacheDemo:
@@ -382,7 +383,11 @@ class CacheDemo:
 @click.option('--quick', is_flag=True, help='Run a quick demo with smaller data size')
 @click.option('--writes-only', is_flag=True, help='Demo write performance only')
 @click.option('--reads-only', is_flag=True, help='Demo read performance only')
-def main(quick, writes_only, reads_only):
+@click.option('--debug', is_flag=True, help='Show the SQL the cache manager runs')
+def main(quick, writes_only, reads_only, debug):
+    logging.basicConfig(format='[%(levelname)s] %(message)s')
+    logging.getLogger('cache_manager').setLevel('DEBUG' if debug else LOG_LEVEL)
+    
     if quick:
         DEMO_CONFIG['sample_data_size'] = 100
         DEMO_CONFIG['write_batch_size'] = 4
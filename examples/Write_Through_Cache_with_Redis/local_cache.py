@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class LocalCache:
+    # in-process LRU that sits in front of redis, bounded by entry count and by (approximate) bytes
+    
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        # (found, value) so a cached None (row doesn't exist) is still a hit
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            
+            value, size, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return False, None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+    
+    def set(self, key: Hashable, value: Any, size: int, ttl: Optional[float] = None):
+        if size > self.max_bytes:
+            return
+        
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            
+            self._entries[key] = (value, size, time.monotonic() + ttl)
+            self._bytes += size
+            
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+    
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def _remove(self, key: Hashable):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+    
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'l1_hits': self.hits,
+            'l1_misses': self.misses,
+            'l1_hit_ratio_percent': (self.hits / lookups * 100) if lookups > 0 else 0,
+            'l1_entries': len(self._entries),
+            'l1_bytes': self._bytes,
+            'l1_evictions': self.evictions
+        }
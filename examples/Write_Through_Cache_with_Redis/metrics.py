@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Tuple
+
+
+# histogram buckets start at 10us and each is 2^(1/4) wider than the last, up to ~170s,
+# so a percentile read off the buckets is never more than ~19% above the real value
+LOWEST_BUCKET = 10e-6
+BUCKETS_PER_DOUBLING = 4
+BUCKET_COUNT = 96
+
+OPERATIONS = ('read_hit', 'read_miss', 'read_many', 'read_by', 'query', 'write', 'batch_write')
+BACKENDS = ('total', 'redis', 'sqlite')
+
+
+class Counters:
+    # the old stats dict, but increments take a lock so threads don't lose updates
+    
+    def __init__(self, names: Iterable[str]):
+        self._names = list(names)
+        self._values = dict.fromkeys(self._names, 0)
+        self._lock = threading.Lock()
+    
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            self._values[name] += amount
+    
+    def __getitem__(self, name: str) -> int:
+        return self._values[name]
+    
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._values)
+    
+    def reset(self):
+        with self._lock:
+            self._values = dict.fromkeys(self._names, 0)
+
+
+class LatencyHistogram:
+    
+    def __init__(self):
+        self.bounds = [LOWEST_BUCKET * 2 ** (i / BUCKETS_PER_DOUBLING) for i in range(BUCKET_COUNT)]
+        self._counts = [0] * (BUCKET_COUNT + 1)  # the extra one holds everything above the last bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+    
+    def record(self, seconds: float):
+        index = bisect_left(self.bounds, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+    
+    def percentile(self, pct: float) -> float:
+        with self._lock:
+            counts, count, maximum = list(self._counts), self.count, self.max
+        if count == 0:
+            return 0.0
+        
+        target = pct / 100 * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            cumulative += bucket_count
+            if cumulative >= target and bucket_count:
+                # upper bound of the bucket, but never more than the slowest value we actually saw
+                return min(self.bounds[index], maximum) if index < BUCKET_COUNT else maximum
+        return maximum
+    
+    def cumulative_counts(self, every: int) -> List[Tuple[float, int]]:
+        # coarser buckets for export, every n-th bound still lines up exactly with ours
+        with self._lock:
+            counts = list(self._counts)
+        
+        result = []
+        cumulative = 0
+        for index, bound in enumerate(self.bounds):
+            cumulative += counts[index]
+            if index % every == every - 1:
+                result.append((bound, cumulative))
+        return result
+    
+    def snapshot(self) -> Dict:
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count * 1000 if self.count else 0,
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'p999_ms': self.percentile(99.9) * 1000,
+            'max_ms': self.max * 1000
+        }
+
+
+class LatencyTracker:
+    # one histogram per (operation, backend). an operation is bracketed by start() and finish(),
+    # the redis and sqlite calls in between are wrapped in timed() so the total can be split up
+    
+    def __init__(self):
+        self.histograms = {(operation, backend): LatencyHistogram() for operation in OPERATIONS for backend in BACKENDS}
+        self._local = threading.local()
+    
+    def start(self):
+        self._local.spent = {}
+    
+    @contextmanager
+    def timed(self, backend: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # background threads (flushers) aren't inside an operation, nothing to add to
+            spent = getattr(self._local, 'spent', None)
+            if spent is not None:
+                spent[backend] = spent.get(backend, 0.0) + time.perf_counter() - start
+    
+    def finish(self, operation: str, seconds: float):
+        spent = getattr(self._local, 'spent', None) or {}
+        self._local.spent = None
+        
+        self.histograms[(operation, 'total')].record(seconds)
+        for backend, backend_seconds in spent.items():
+            self.histograms[(operation, backend)].record(backend_seconds)
+    
+    def snapshot(self) -> Dict:
+        result = {}
+        for (operation, backend), histogram in self.histograms.items():
+            if histogram.count:
+                result.setdefault(operation, {})[backend] = histogram.snapshot()
+        return result
+    
+    def reset(self):
+        for key in self.histograms:
+            self.histograms[key] = LatencyHistogram()
+
+
+def render_prometheus(prefix: str, counters: Dict[str, int], gauges: Dict[str, float], latency: LatencyTracker) -> str:
+    lines = []
+    for name, value in counters.items():
+        # total_reads -> reads_total
+        name = name[len('total_'):] if name.startswith('total_') else name
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        lines.append(f"{prefix}_{name}_total {value}")
+    
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {prefix}_{name} gauge")
+        lines.append(f"{prefix}_{name} {value}")
+    
+    metric = f"{prefix}_latency_seconds"
+    lines.append(f"# HELP {metric} Time per cache operation, backend=total is the whole call")
+    lines.append(f"# TYPE {metric} histogram")
+    for (operation, backend), histogram in latency.histograms.items():
+        if not histogram.count:
+            continue
+        labels = f'operation="{operation}",backend="{backend}"'
+        # one exported bucket per doubling keeps the output readable
+        for bound, cumulative in histogram.cumulative_counts(BUCKETS_PER_DOUBLING):
+            lines.append(f'{metric}_bucket{{{labels},le="{bound:.6g}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f'{metric}_sum{{{labels}}} {histogram.total}')
+        lines.append(f'{metric}_count{{{labels}}} {histogram.count}')
+    
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(render: Callable[[], str], host: str, port: int) -> ThreadingHTTPServer:
+    class MetricsHandler(BaseHTTPRequestHandler):
+        
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            # scrapes every few seconds would flood the demo output
+            pass
+    
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import math
+import multiprocessing
+import platform
+import random
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import redirect_stdout
+from itertools import accumulate
+from typing import Dict, List, Optional
+
+import click
+from tabulate import tabulate
+
+from cache_manager import WriteThoughCacheManager
+from codec_benchmark import generate_users
+from config import DEMO_CONFIG
+
+
+PERCENTILES = [50, 95, 99, 99.9]
+
+
+class KeySampler:
+    # picks which existing id each read goes to
+    
+    def __init__(self, ids: List[int], distribution: str, zipf_s: float, rng: random.Random):
+        self.ids = list(ids)
+        self.rng = rng
+        self.distribution = distribution
+        if distribution == 'zipf':
+            # rank 1 is the hottest key, shuffled so hotness isn't tied to insertion order
+            rng.shuffle(self.ids)
+            self.cumulative = list(accumulate(1.0 / (rank ** zipf_s) for rank in range(1, len(self.ids) + 1)))
+    
+    def next(self) -> int:
+        if self.distribution == 'zipf':
+            point = self.rng.random() * self.cumulative[-1]
+            return self.ids[min(bisect_left(self.cumulative, point), len(self.ids) - 1)]
+        return self.rng.choice(self.ids)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # nearest rank, pct * n first so 95 of 100 values is exactly rank 95
+    index = max(0, min(len(sorted_values) - 1, math.ceil(pct * len(sorted_values) / 100) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float], failed: int, window: float) -> Dict:
+    # latencies are only the operations that worked, a failure that returns early would flatter them
+    values = sorted(latencies)
+    summary = {
+        'count': len(values),
+        'failed': failed,
+        'throughput_ops': len(values) / window if window > 0 else 0,
+        'mean_ms': sum(values) / len(values) if values else 0,
+        'max_ms': values[-1] if values else 0
+    }
+    for pct in PERCENTILES:
+        summary[f'p{pct:g}_ms'.replace('.', '')] = percentile(values, pct)
+    return summary
+
+
+def connect_quietly() -> WriteThoughCacheManager:
+    # the manager is chatty on connect, which would drown the report
+    manager = WriteThoughCacheManager()
+    with redirect_stdout(io.StringIO()):
+        manager.connect()
+    return manager
+
+
+def run_worker(worker_id: int, settings: Dict, ids: List[int], barrier,
+               manager: Optional[WriteThoughCacheManager] = None) -> Dict:
+    rng = random.Random(settings['seed'] + worker_id)
+    sampler = KeySampler(ids, settings['distribution'], settings['zipf_s'], rng)
+    own_manager = manager is None
+    if own_manager:
+        manager = connect_quietly()
+    
+    latencies = {'read': [], 'write': []}
+    failures = {'read': 0, 'write': 0}
+    total = settings['warmup'] + settings['operations']
+    started_at = None
+    
+    try:
+        for i in range(total):
+            if i == settings['warmup']:
+                # everyone starts measuring together, after their own warmup
+                barrier.wait()
+                started_at = time.time()
+            
+            is_read = rng.random() < settings['read_ratio']
+            op_start = time.perf_counter()
+            # every id read exists, so a None is an error the manager swallowed, like a False from set
+            if is_read:
+                ok = manager.get(settings['table'], sampler.next()) is not None
+            else:
+                ok = manager.set(settings['table'], {
+                    'username': f"bench_{settings['run_id']}_w{worker_id}_{i}",
+                    'email': f"bench{worker_id}_{i}@university.edu",
+                    'profile_data': '{}'
+                })
+            elapsed_ms = (time.perf_counter() - op_start) * 1000
+            
+            if i >= settings['warmup']:
+                if ok:
+                    latencies['read' if is_read else 'write'].append(elapsed_ms)
+                else:
+                    failures['read' if is_read else 'write'] += 1
+        
+        if started_at is None:
+            barrier.wait()
+            started_at = time.time()
+        return {'latencies': latencies, 'failures': failures, 'started_at': started_at, 'finished_at': time.time()}
+    
+    finally:
+        if own_manager:
+            manager.close()
+
+
+def process_worker(worker_id: int, settings: Dict, ids: List[int], barrier, results):
+    results.put(run_worker(worker_id, settings, ids, barrier))
+
+
+def load_dataset(manager: WriteThoughCacheManager, settings: Dict) -> List[int]:
+    table = settings['table']
+    if settings['reuse_data']:
+        manager.flush()
+        cursor = manager.sqlite_conn.execute(f"SELECT id FROM {table} ORDER BY id LIMIT ?", (settings['records'],))
+        return [row[0] for row in cursor.fetchall()]
+    
+    rows = []
+    for i, user in enumerate(generate_users(settings['records'])):
+        user.pop('id')
+        user.pop('created_at')
+        user['username'] = f"bench_{settings['run_id']}_{i}"
+        user['email'] = f"bench_{settings['run_id']}_{i}@university.edu"
+        rows.append(user)
+    
+    for i in range(0, len(rows), DEMO_CONFIG['batch_size'] * 10):
+        manager.batch_write(table, rows[i:i + DEMO_CONFIG['batch_size'] * 10])
+    
+    # with write-behind on the rows are only queued, wait until they're in sqlite
+    manager.flush()
+    cursor = manager.sqlite_conn.execute(
+        f"SELECT id FROM {table} WHERE username LIKE ?", (f"bench_{settings['run_id']}_%",)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def run_benchmark(settings: Dict) -> Dict:
+    manager = connect_quietly()
+    try:
+        ids = load_dataset(manager, settings)
+        if not ids:
+            raise click.ClickException(f"No rows in {settings['table']} to read, drop --reuse-data or load some first")
+        if settings['cold']:
+            manager.clear_cache()
+        
+        redis_info = manager.redis_client.info('server')
+        concurrency = settings['concurrency']
+        if settings['mode'] == 'thread':
+            barrier = threading.Barrier(concurrency)
+            outputs = [None] * concurrency
+            
+            def thread_worker(worker_id):
+                outputs[worker_id] = run_worker(worker_id, settings, ids, barrier, manager)
+            
+            threads = [threading.Thread(target=thread_worker, args=(n,)) for n in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            # spawn so workers don't inherit the parent's threads and sockets
+            context = multiprocessing.get_context('spawn')
+            barrier = context.Barrier(concurrency)
+            queue = context.Queue()
+            processes = [
+                context.Process(target=process_worker, args=(n, settings, ids, barrier, queue))
+                for n in range(concurrency)
+            ]
+            for process in processes:
+                process.start()
+            outputs = [queue.get() for _ in processes]
+            for process in processes:
+                process.join()
+        
+        manager_stats = manager.get_cache_stats()
+    finally:
+        manager.close()
+    
+    window = max(o['finished_at'] for o in outputs) - min(o['started_at'] for o in outputs)
+    reads = [ms for o in outputs for ms in o['latencies']['read']]
+    writes = [ms for o in outputs for ms in o['latencies']['write']]
+    failed_reads = sum(o['failures']['read'] for o in outputs)
+    failed_writes = sum(o['failures']['write'] for o in outputs)
+    
+    return {
+        'run_id': settings['run_id'],
+        'label': settings['label'],
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'redis_version': redis_info.get('redis_version', 'unknown')
+        },
+        'settings': {k: v for k, v in settings.items() if k != 'run_id'},
+        'wall_time_s': window,
+        'results': {
+            'all': summarize(reads + writes, failed_reads + failed_writes, window),
+            'read': summarize(reads, failed_reads, window),
+            'write': summarize(writes, failed_writes, window)
+        },
+        # only meaningful in thread mode, process workers keep their own counters
+        'manager_stats': manager_stats
+    }
+
+
+def print_report(report: Dict):
+    settings = report['settings']
+    print(f"[PERF] {settings['concurrency']} {settings['mode']}s, {settings['records']} records, "
+          f"{settings['distribution']} keys, {settings['read_ratio']:.0%} reads, {report['wall_time_s']:.2f}s")
+    
+    rows = [["Operation", "Count", "Failed", "Ops/sec", "Mean (ms)", "p50", "p95", "p99", "p999", "Max"]]
+    for name, result in report['results'].items():
+        rows.append([
+            name, result['count'], result['failed'], f"{result['throughput_ops']:.0f}", f"{result['mean_ms']:.3f}",
+            f"{result['p50_ms']:.3f}", f"{result['p95_ms']:.3f}", f"{result['p99_ms']:.3f}",
+            f"{result['p999_ms']:.3f}", f"{result['max_ms']:.3f}"
+        ])
+    print(tabulate(rows, headers="firstrow", tablefmt="grid"))
+
+
+@click.command()
+@click.option('--records', default=DEMO_CONFIG['sample_data_size'], help='Rows loaded (or reused) for reads')
+@click.option('--operations', default=DEMO_CONFIG['performance_iterations'], help='Measured operations per worker')
+@click.option('--warmup', default=100, help='Unmeasured operations per worker before measuring')
+@click.option('--concurrency', default=4, help='Number of workers')
+@click.option('--mode', type=click.Choice(['thread', 'process']), default='thread')
+@click.option('--distribution', type=click.Choice(['uniform', 'zipf']), default='zipf')
+@click.option('--zipf-s', default=1.1, help='Zipf exponent, higher means fewer, hotter keys')
+@click.option('--read-ratio', default=0.9, help='Fraction of operations that are reads')
+# the generated rows and the writes are users rows, other tables have different columns
+@click.option('--table', type=click.Choice(['users']), default='users')
+@click.option('--reuse-data', is_flag=True, help='Read rows already in the table instead of loading new ones')
+@click.option('--cold', is_flag=True, help='Clear the cache before measuring')
+@click.option('--seed', default=42)
+@click.option('--label', default='', help='Free text stored with the results')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the report as JSON to this file')
+def main(records, operations, warmup, concurrency, mode, distribution, zipf_s, read_ratio, table,
+         reuse_data, cold, seed, label, output):
+    settings = {
+        'run_id': uuid.uuid4().hex[:8],
+        'label': label,
+        'records': records,
+        'operations': operations,
+        'warmup': warmup,
+        'concurrency': concurrency,
+        'mode': mode,
+        'distribution': distribution,
+        'zipf_s': zipf_s,
+        'read_ratio': read_ratio,
+        'table': table,
+        'reuse_data': reuse_data,
+        'cold': cold,
+        'seed': seed
+    }
+    
+    report = run_benchmark(settings)
+    print_report(report)
+    
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"[INFO] Report written to {output}")
+
+
+if __name__ == "__main__":
+    main()
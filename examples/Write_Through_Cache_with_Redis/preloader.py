@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import click
+
+from cache_manager import WriteThoughCacheManager
+from config import DEMO_CONFIG, NAMESPACE_CONFIG, PRELOAD_CONFIG
+from row_storage import HASH_FILL_SCRIPT, fill_args
+
+
+class CachePreloader:
+    # fills the cache ahead of traffic using the manager's own keys and serializer.
+    # entries are written with SET NX, so anything a live write put there in the meantime is never overwritten
+    
+    def __init__(self, cache_manager: WriteThoughCacheManager, rows_per_second: Optional[float] = None,
+                 chunk_size: Optional[int] = None, on_progress: Optional[Callable[[Dict], None]] = None):
+        self.cache_manager = cache_manager
+        self.rows_per_second = rows_per_second if rows_per_second is not None else PRELOAD_CONFIG['rows_per_second']
+        self.chunk_size = chunk_size or PRELOAD_CONFIG['chunk_size']
+        self.on_progress = on_progress or self._print_progress
+        self.progress = {'table': None, 'loaded': 0, 'skipped': 0, 'total': 0, 'started_at': None, 'running': False}
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_report = 0
+        self._hash_fill_script = None  # registered on first use, the manager may not be connected yet
+    
+    def preload_table(self, table: str, where: Optional[str] = None, params: Tuple = ()) -> int:
+        readers = self.cache_manager.readers
+        where_sql = f" AND ({where})" if where else ""
+        with readers.connection() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE 1 = 1{where_sql}", params).fetchone()[0]
+        self._begin(table, total)
+        
+        # keyset pages rather than one long cursor, a read transaction held for the whole
+        # (rate limited) run would stop sqlite from checkpointing the WAL. the connection goes back to the
+        # pool between pages too, so the preloader never keeps one from live reads while it waits
+        last_id = 0
+        while not self._stop.is_set():
+            with readers.connection() as conn:
+                rows = conn.execute(
+                    f"SELECT * FROM {table} WHERE id > ?{where_sql} ORDER BY id LIMIT ?",
+                    (last_id, *params, self.chunk_size)
+                ).fetchall()
+            if not rows:
+                break
+            self._write_chunk(table, [dict(row) for row in rows])
+            last_id = rows[-1]['id']
+        
+        return self._finish()
+    
+    def preload_recent(self, window: Optional[int] = None, limit: Optional[int] = None) -> int:
+        # rows that were read or written recently, most used first
+        self.cache_manager.flush_performance_log()
+        window = window or PRELOAD_CONFIG['recent_window']
+        limit = limit or PRELOAD_CONFIG['recent_limit']
+        
+        readers = self.cache_manager.readers
+        with readers.connection() as conn:
+            recent = conn.execute('''
+                SELECT table_name, record_key FROM performance_log
+                WHERE record_key IS NOT NULL AND timestamp >= datetime('now', ?)
+                GROUP BY table_name, record_key
+                ORDER BY COUNT(*) DESC
+                LIMIT ?
+            ''', (f"-{int(window)} seconds", limit)).fetchall()
+        
+        keys_by_table = {}
+        for table, key in recent:
+            # table names end up in sql, only trust the ones we know
+            if table in NAMESPACE_CONFIG['tables']:
+                keys_by_table.setdefault(table, []).append(key)
+        
+        loaded = 0
+        chunk_size = min(self.chunk_size, DEMO_CONFIG['sql_in_chunk_size'])
+        for table, keys in keys_by_table.items():
+            self._begin(table, len(keys))
+            for i in range(0, len(keys), chunk_size):
+                if self._stop.is_set():
+                    break
+                chunk = keys[i:i + chunk_size]
+                with readers.connection() as conn:
+                    rows = conn.execute(
+                        f"SELECT * FROM {table} WHERE id IN ({', '.join('?' for _ in chunk)})", chunk
+                    ).fetchall()
+                self._write_chunk(table, [dict(row) for row in rows])
+            loaded += self._finish()
+        return loaded
+    
+    def start(self, tables: Optional[List[str]] = None, recent: bool = False) -> threading.Thread:
+        # runs next to live traffic, the rate limit is what keeps it from competing with it
+        def run():
+            try:
+                if recent:
+                    self.preload_recent()
+                for table in tables or []:
+                    if self._stop.is_set():
+                        break
+                    self.preload_table(table)
+            except Exception as e:
+                print(f"Error during preload: {e}")
+        
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name='cache-preloader', daemon=True)
+        self._thread.start()
+        return self._thread
+    
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        if self._thread:
+            self._thread.join(timeout)
+            return not self._thread.is_alive()
+        return True
+    
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        self.wait(timeout)
+    
+    def _write_chunk(self, table: str, rows: List[Dict]):
+        manager = self.cache_manager
+        pipe = manager.cache_client.pipeline(transaction=False)
+        for data in rows:
+            ttl = int(DEMO_CONFIG['cache_ttl'] * (1 - random.random() * PRELOAD_CONFIG['ttl_jitter']))
+            cache_key = manager._generate_cache_key(table, data['id'])
+            if table in manager.hash_tables:
+                if self._hash_fill_script is None:
+                    self._hash_fill_script = manager.cache_client.register_script(HASH_FILL_SCRIPT)
+                self._hash_fill_script(keys=[cache_key], args=fill_args(data, ttl), client=pipe)
+            else:
+                pipe.set(cache_key, manager.serializer.dumps(data), ex=ttl, nx=True)
+        written = sum(1 for result in pipe.execute() if result)
+        
+        self.progress['loaded'] += written
+        self.progress['skipped'] += len(rows) - written
+        self._throttle()
+        
+        if time.time() - self._last_report >= PRELOAD_CONFIG['progress_interval']:
+            self._last_report = time.time()
+            self.on_progress(dict(self.progress))
+    
+    def _throttle(self):
+        if not self.rows_per_second:
+            return
+        
+        done = self.progress['loaded'] + self.progress['skipped']
+        ahead = done / self.rows_per_second - (time.time() - self.progress['started_at'])
+        if ahead > 0:
+            # wait on the stop event so stop() doesn't have to sit out the sleep
+            self._stop.wait(ahead)
+    
+    def _begin(self, table: str, total: int):
+        self.progress = {
+            'table': table,
+            'loaded': 0,
+            'skipped': 0,
+            'total': total,
+            'started_at': time.time(),
+            'running': True
+        }
+        self._last_report = time.time()
+    
+    def _finish(self) -> int:
+        self.progress['running'] = False
+        self.on_progress(dict(self.progress))
+        return self.progress['loaded']
+    
+    def _print_progress(self, progress: Dict):
+        done = progress['loaded'] + progress['skipped']
+        elapsed = time.time() - progress['started_at']
+        rate = done / elapsed if elapsed > 0 else 0
+        state = "running" if progress['running'] else ("done" if done >= progress['total'] else "stopped")
+        print(f"[PRELOAD] {progress['table']}: {done}/{progress['total']} rows, {progress['loaded']} cached, "
+              f"{progress['skipped']} already there ({rate:.0f} rows/s, {state})")
+
+
+@click.command()
+@click.option('--table', 'tables', multiple=True, help='Table to preload, can be repeated (default: every table)')
+@click.option('--recent', is_flag=True, help='Preload the rows used most in the recent performance_log instead')
+@click.option('--window', default=PRELOAD_CONFIG['recent_window'], help='Seconds of performance_log --recent looks at')
+@click.option('--rate', type=float, default=PRELOAD_CONFIG['rows_per_second'], help='Rows per second, 0 for no limit')
+def main(tables, recent, window, rate):
+    cache_manager = WriteThoughCacheManager()
+    cache_manager.connect()
+    
+    try:
+        preloader = CachePreloader(cache_manager, rows_per_second=rate or 0)
+        if recent:
+            preloader.preload_recent(window)
+        for table in tables or ([] if recent else NAMESPACE_CONFIG['tables']):
+            preloader.preload_table(table)
+    finally:
+        cache_manager.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+
+# tables in STORAGE_CONFIG['hash_tables'] are cached as one redis hash per row, a field per column.
+# values are plain strings (no codec tag) so small rows stay in redis' compact listpack encoding
+
+# the whole hash of a row cached as "doesn't exist", no real column can have this name
+MISSING_FIELD = '__missing__'
+
+# fills a row only if nothing is cached under the key yet, ARGV = ttl, field, value, field, value...
+HASH_FILL_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# patches fields of a cached row in place. a hash that isn't a whole row (not cached, or cached as missing)
+# is left alone, otherwise it would come back as a row with every other column gone.
+# ARGV = number of pairs to set, field, value..., then the fields to delete (set to NULL)
+HASH_UPDATE_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], 'id') == 0 then
+    return 0
+end
+local pairs_end = 1 + tonumber(ARGV[1]) * 2
+if pairs_end > 1 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 2, pairs_end))
+end
+if #ARGV > pairs_end then
+    redis.call('HDEL', KEYS[1], unpack(ARGV, pairs_end + 1))
+end
+return 1
+"""
+
+
+def numeric(value: str) -> Union[int, float, str]:
+    # sqlite NUMERIC affinity: a number if it looks like one, the text otherwise (e.g. TIMESTAMP columns)
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def column_converter(declared_type: str) -> Callable[[str], Any]:
+    # same rules sqlite uses to pick a column's affinity from its declared type
+    declared = (declared_type or '').upper()
+    if 'INT' in declared:
+        return int
+    if 'CHAR' in declared or 'CLOB' in declared or 'TEXT' in declared or not declared or 'BLOB' in declared:
+        return str
+    if 'REAL' in declared or 'FLOA' in declared or 'DOUB' in declared:
+        return float
+    return numeric
+
+
+def encode_field(value: Any) -> Union[str, int, float, bytes]:
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (str, int, float, bytes)):
+        return value
+    return str(value)
+
+
+def encode_row(data: Dict) -> Tuple[Dict[str, Any], List[str]]:
+    # (fields to set, fields that are NULL), NULL columns simply aren't in the hash
+    fields = {column: encode_field(value) for column, value in data.items() if value is not None}
+    nulls = [column for column, value in data.items() if value is None]
+    return fields, nulls
+
+
+def decode_fields(raw: Dict[bytes, bytes], converters: Dict[str, Callable]) -> Dict:
+    row = {}
+    for field, value in raw.items():
+        column = field.decode('utf-8')
+        row[column] = converters.get(column, str)(value.decode('utf-8'))
+    return row
+
+
+def decode_cached(raw: Any, serializer, converters: Optional[Dict[str, Callable]]) -> Tuple[bool, Optional[Dict]]:
+    # (found, row) for a value read by GET (converters is None) or HGETALL, a cached miss is (True, None)
+    if not raw:
+        return False, None
+    if converters is None:
+        return True, serializer.loads(raw)
+    if MISSING_FIELD.encode('utf-8') in raw:
+        return True, None
+    # NULL columns aren't stored, put them back so rows look the same as in string mode
+    return True, {**dict.fromkeys(converters), **decode_fields(raw, converters)}
+
+
+def raw_size(raw: Any) -> int:
+    if isinstance(raw, dict):
+        return sum(len(field) + len(value) for field, value in raw.items())
+    return len(raw) if raw else 0
+
+
+def stage_read(pipe, cache_key: str, hash_mode: bool):
+    if hash_mode:
+        pipe.hgetall(cache_key)
+    else:
+        pipe.get(cache_key)
+
+
+def stage_row(pipe, cache_key: str, data: Optional[Dict], ttl: int, serializer, hash_mode: bool) -> int:
+    # queues the commands that cache one row on a (sync or asyncio) pipeline, returns its approximate size
+    if not hash_mode:
+        payload = serializer.dumps(data)
+        pipe.setex(cache_key, ttl, payload)
+        return len(payload)
+    
+    fields, _ = encode_row(data) if data is not None else ({MISSING_FIELD: 1}, [])
+    # replace, not merge, so columns of whatever was cached before don't linger
+    pipe.delete(cache_key)
+    pipe.hset(cache_key, mapping=fields)
+    pipe.expire(cache_key, ttl)
+    return sum(len(column) + len(str(value)) for column, value in fields.items())
+
+
+def fill_args(data: Optional[Dict], ttl: int) -> List:
+    fields, _ = encode_row(data) if data is not None else ({MISSING_FIELD: 1}, [])
+    args = [ttl]
+    for column, value in fields.items():
+        args.extend([column, value])
+    return args
+
+
+def update_args(changes: Dict) -> List:
+    fields, nulls = encode_row(changes)
+    args = [len(fields)]
+    for column, value in fields.items():
+        args.extend([column, value])
+    return args + nulls
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import json
+import zlib
+from typing import Any, Dict, Optional
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# first byte of every cached value says how the rest was written
+# none of these can start a json document, so entries cached before the tag existed still decode
+TAG_JSON = 0x01
+TAG_MSGPACK = 0x02
+TAG_ZLIB = 0x03
+TAG_LZ4 = 0x04
+
+
+class JsonCodec:
+    tag = TAG_JSON
+    
+    def encode(self, value: Any) -> bytes:
+        return json.dumps(value, default=str, separators=(',', ':')).encode('utf-8')
+    
+    def decode(self, body: bytes) -> Any:
+        return json.loads(body)
+
+
+class MsgpackCodec:
+    tag = TAG_MSGPACK
+    
+    def __init__(self):
+        if msgpack is None:
+            raise ValueError("msgpack codec needs the msgpack package (pip install msgpack)")
+    
+    def encode(self, value: Any) -> bytes:
+        return msgpack.packb(value, default=str, use_bin_type=True)
+    
+    def decode(self, body: bytes) -> Any:
+        return msgpack.unpackb(body, raw=False)
+
+
+class ZlibCompressor:
+    tag = TAG_ZLIB
+    
+    def compress(self, body: bytes) -> bytes:
+        return zlib.compress(body, 6)
+    
+    def decompress(self, body: bytes) -> bytes:
+        return zlib.decompress(body)
+
+
+class Lz4Compressor:
+    tag = TAG_LZ4
+    
+    def __init__(self):
+        if lz4 is None:
+            raise ValueError("lz4 compression needs the lz4 package (pip install lz4)")
+    
+    def compress(self, body: bytes) -> bytes:
+        return lz4.frame.compress(body)
+    
+    def decompress(self, body: bytes) -> bytes:
+        return lz4.frame.decompress(body)
+
+
+CODECS = {
+    'json': JsonCodec,
+    'msgpack': MsgpackCodec
+}
+
+COMPRESSORS = {
+    'zlib': ZlibCompressor,
+    'lz4': Lz4Compressor
+}
+
+CODECS_BY_TAG = {codec.tag: codec for codec in CODECS.values()}
+COMPRESSORS_BY_TAG = {compressor.tag: compressor for compressor in COMPRESSORS.values()}
+
+
+class CacheSerializer:
+    # writes with one configured codec, reads anything any codec (or the old untagged json) wrote
+    
+    def __init__(self, codec: str = 'json', compression: Optional[str] = None, compress_threshold: int = 512):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec!r}, expected one of {list(CODECS)}")
+        if compression is not None and compression not in COMPRESSORS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {list(COMPRESSORS)}")
+        
+        self.codec = CODECS[codec]()
+        self.compressor = COMPRESSORS[compression]() if compression else None
+        self.compress_threshold = compress_threshold
+        self._by_tag = {self.codec.tag: self.codec}
+        if self.compressor:
+            self._by_tag[self.compressor.tag] = self.compressor
+    
+    def dumps(self, value: Any) -> bytes:
+        frame = bytes([self.codec.tag]) + self.codec.encode(value)
+        
+        if self.compressor and len(frame) >= self.compress_threshold:
+            compressed = bytes([self.compressor.tag]) + self.compressor.compress(frame)
+            # incompressible rows are kept as they are
+            if len(compressed) < len(frame):
+                return compressed
+        return frame
+    
+    def loads(self, raw: bytes) -> Any:
+        tag, body = raw[0], raw[1:]
+        
+        if tag in COMPRESSORS_BY_TAG:
+            return self.loads(self._for_tag(tag).decompress(body))
+        if tag in CODECS_BY_TAG:
+            return self._for_tag(tag).decode(body)
+        
+        # written before codec tags existed
+        return json.loads(raw)
+    
+    def _for_tag(self, tag: int):
+        # readers may meet entries written with a codec they aren't configured to write
+        if tag not in self._by_tag:
+            self._by_tag[tag] = {**CODECS_BY_TAG, **COMPRESSORS_BY_TAG}[tag]()
+        return self._by_tag[tag]
+
+
+def get_serializer(config: Dict) -> CacheSerializer:
+    return CacheSerializer(config['codec'], config['compression'], config['compress_threshold'])
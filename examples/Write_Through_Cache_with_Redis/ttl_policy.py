@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import random
+import threading
+from array import array
+from typing import Dict, Optional
+
+
+class FixedTtlPolicy:
+    # what the manager always did: every row lives cache_ttl seconds, every miss is cached
+    name = 'fixed'
+    
+    def __init__(self, config: Dict, base_ttl: int):
+        self.base_ttl = base_ttl
+    
+    def record_access(self, cache_key: str):
+        pass
+    
+    def ttl_for(self, cache_key: str) -> int:
+        return self.base_ttl
+    
+    def peek_ttl(self, cache_key: str) -> int:
+        return self.base_ttl
+    
+    def admit(self, cache_key: str) -> bool:
+        return True
+    
+    def sliding_ttl(self, cache_key: str) -> Optional[int]:
+        return None
+    
+    def get_stats(self) -> Dict:
+        return {'ttl_policy': self.name}
+
+
+class CountMinSketch:
+    # approximate read counts per key in fixed memory. counts only ever overestimate,
+    # and every counter is halved once per reset_after increments so old popularity fades out
+    
+    def __init__(self, width: int, depth: int, reset_after: int):
+        if width & (width - 1):
+            raise ValueError(f"sketch width must be a power of two, got {width}")
+        self.mask = width - 1
+        self.shift = width.bit_length() - 1
+        # every row takes its index from its own slice of one 64-bit hash
+        if depth * self.shift > 64:
+            raise ValueError(f"sketch depth * log2(width) must fit in 64 bits, got {depth} * {self.shift}")
+        self.depth = depth
+        self.rows = [array('I', bytes(4 * width)) for _ in range(depth)]
+        self.width = width
+        self.counters = width * depth
+        self.reset_after = reset_after
+        self.additions = 0
+        self.aged = 0  # counters already halved in this round
+        self.resets = 0
+        self._lock = threading.Lock()  # aging only, the counters themselves are bumped without it
+    
+    def _indexes(self, key: str):
+        # one 64-bit hash cut into depth slices, python's str hash is randomized per process which is fine here
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        for row in range(self.depth):
+            yield row, (h >> (row * self.shift)) & self.mask
+    
+    def add(self, key: str):
+        # a lost increment under contention only makes a count a little low, so those take no lock.
+        # the aging position does, two threads moving it at once would halve counters twice or run off the end
+        for row, index in self._indexes(key):
+            self.rows[row][index] += 1
+        with self._lock:
+            self.additions += 1
+            self._age()
+    
+    def estimate(self, key: str) -> int:
+        return min(self.rows[row][index] for row, index in self._indexes(key))
+    
+    def _age(self):
+        # halving the whole sketch at once is a few hundred thousand counters on whichever read hit the limit,
+        # instead each add halves its share, so by reset_after adds every counter was halved exactly once.
+        # called with _lock held
+        target = min(self.additions * self.counters // self.reset_after, self.counters)
+        while self.aged < target:
+            self.rows[self.aged // self.width][self.aged % self.width] >>= 1
+            self.aged += 1
+        if self.additions >= self.reset_after:
+            self.additions = 0
+            self.aged = 0
+            self.resets += 1
+
+
+class AdaptiveTtlPolicy:
+    # ttl follows how often this process has read the key recently:
+    # hot keys live longer and slide forward on reads, keys read once live briefly or aren't cached at all
+    name = 'adaptive'
+    
+    def __init__(self, config: Dict, base_ttl: int):
+        self.base_ttl = base_ttl
+        self.hot_ttl = config['hot_ttl']
+        self.hot_threshold = config['hot_threshold']
+        self.cold_ttl = config['cold_ttl']
+        self.admit_after = config['admit_after']
+        self.sliding = config['sliding']
+        self.sliding_sample = config['sliding_sample']
+        self.sketch = CountMinSketch(config['sketch_width'], config['sketch_depth'], config['sketch_reset_after'])
+        self.counts = {'hot': 0, 'warm': 0, 'cold': 0, 'rejected': 0, 'slid': 0}
+    
+    def record_access(self, cache_key: str):
+        self.sketch.add(cache_key)
+    
+    def ttl_for(self, cache_key: str) -> int:
+        ttl = self.peek_ttl(cache_key)
+        self.counts['hot' if ttl == self.hot_ttl else 'cold' if ttl == self.cold_ttl else 'warm'] += 1
+        return ttl
+    
+    def peek_ttl(self, cache_key: str) -> int:
+        # same choice as ttl_for without counting it, for the l1 copy of a row already in redis
+        reads = self.sketch.estimate(cache_key)
+        if reads >= self.hot_threshold:
+            return self.hot_ttl
+        # 0 is a write to a key nobody has read yet, that gets the benefit of the doubt
+        if reads == 1:
+            return self.cold_ttl
+        return self.base_ttl
+    
+    def admit(self, cache_key: str) -> bool:
+        # tinylfu style doorkeeper, a key has to be read a few times before a miss puts it in redis
+        if self.sketch.estimate(cache_key) >= self.admit_after:
+            return True
+        self.counts['rejected'] += 1
+        return False
+    
+    def sliding_ttl(self, cache_key: str) -> Optional[int]:
+        # GETEX is a write, so only a sample of hot reads push the expiry out, hot keys get plenty of samples
+        if not self.sliding or random.random() >= self.sliding_sample:
+            return None
+        if self.sketch.estimate(cache_key) < self.hot_threshold:
+            return None
+        self.counts['slid'] += 1
+        return self.hot_ttl
+    
+    def get_stats(self) -> Dict:
+        return {
+            'ttl_policy': self.name,
+            'ttl_hot_assigned': self.counts['hot'],
+            'ttl_warm_assigned': self.counts['warm'],
+            'ttl_cold_assigned': self.counts['cold'],
+            'ttl_admission_rejected': self.counts['rejected'],
+            'ttl_sliding_refreshes': self.counts['slid'],
+            'ttl_sketch_resets': self.sketch.resets
+        }
+
+
+TTL_POLICIES = {
+    'fixed': FixedTtlPolicy,
+    'adaptive': AdaptiveTtlPolicy
+}
+
+
+def get_ttl_policy(config: Dict, base_ttl: int):
+    if config['policy'] not in TTL_POLICIES:
+        raise ValueError(f"Unknown ttl policy {config['policy']!r}, expected one of {list(TTL_POLICIES)}")
+    return TTL_POLICIES[config['policy']](config, base_ttl)
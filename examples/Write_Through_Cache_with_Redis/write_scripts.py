@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import json
+from typing import Dict, List, Optional, Tuple
+
+from row_storage import encode_row
+
+
+# everything a write does to redis in one atomic call: the rows and their ttls, the index entries they make stale,
+# the table's query generation, the shared write counter and the l1 broadcast. nothing can read a new row next to
+# an old index entry in between, and it's one round trip instead of a pipeline of five kinds of commands.
+# KEYS = query generation, write counts, the n row keys, then the index keys to drop
+# ARGV = n, hash mode, table, channel, message, then per row: ttl, payload or ttl, pair count, field, value...
+WRITE_ROWS_SCRIPT = """
+local n = tonumber(ARGV[1])
+local hash_mode = ARGV[2] == '1'
+local arg = 6
+for i = 1, n do
+    local key = KEYS[2 + i]
+    if hash_mode then
+        local pairs_end = arg + 1 + tonumber(ARGV[arg + 1]) * 2
+        redis.call('DEL', key)
+        redis.call('HSET', key, unpack(ARGV, arg + 2, pairs_end))
+        redis.call('EXPIRE', key, ARGV[arg])
+        arg = pairs_end + 1
+    else
+        redis.call('SET', key, ARGV[arg + 1], 'EX', ARGV[arg])
+        arg = arg + 2
+    end
+end
+for i = 3 + n, #KEYS do
+    redis.call('DEL', KEYS[i])
+end
+redis.call('INCR', KEYS[1])
+redis.call('HINCRBY', KEYS[2], ARGV[3], n)
+if ARGV[4] ~= '' then
+    redis.call('PUBLISH', ARGV[4], ARGV[5])
+end
+return n
+"""
+
+
+def write_rows_args(table: str, rows: List[Tuple[str, Dict, int]], index_keys: List[str], generation_key: str,
+                    stats_key: str, serializer, hash_mode: bool, channel: Optional[str] = None,
+                    message: Optional[Dict] = None) -> Tuple[List, List]:
+    # (keys, args) for WRITE_ROWS_SCRIPT, rows are (cache key, row, ttl)
+    keys = [generation_key, stats_key] + [cache_key for cache_key, _, _ in rows] + list(index_keys)
+    args = [len(rows), int(hash_mode), table, channel or '', json.dumps(message) if message else '']
+    for _, data, ttl in rows:
+        if hash_mode:
+            fields, _ = encode_row(data)
+            args.extend([ttl, len(fields)])
+            for column, value in fields.items():
+                args.extend([column, value])
+        else:
+            args.extend([ttl, serializer.dumps(data)])
+    return keys, args